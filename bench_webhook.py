@@ -0,0 +1,158 @@
+"""
+Нагрузочный тест вебхука бота: отправляет обновления Telegram на URL вебхука
+и измеряет запросы в секунду и задержки ответа.
+
+Сравнение серверов (бот запускается с WEBHOOK_URL, PORT и WEBHOOK_SECRET):
+    WEBHOOK_SERVER=asgi python bot.py
+    python bench_webhook.py http://127.0.0.1:8443/telegram --secret "$WEBHOOK_SECRET"
+
+    WEBHOOK_SERVER=ptb python bot.py
+    python bench_webhook.py http://127.0.0.1:8443/telegram --secret "$WEBHOOK_SECRET"
+
+С флагом --junk отправляются запросы с неверным секретом: так измеряется,
+насколько дешево сервер отбрасывает посторонний трафик.
+
+Без доступа к api.telegram.org бот запускается против fake_bot_api.py
+(TELEGRAM_API_BASE_URL=http://127.0.0.1:8081); с флагом --api-stats тест
+сбрасывает его счетчики перед запуском и выводит исходящие вызовы Bot API
+по методам и в расчете на одно обновление:
+    python bench_webhook.py http://127.0.0.1:8443/telegram --secret "$WEBHOOK_SECRET" --api-stats http://127.0.0.1:8081
+"""
+import argparse
+import asyncio
+import json
+import time
+import urllib.request
+from urllib.parse import urlsplit
+
+# Нажатие кнопки "Going" в несуществующем чате: обработчик найдет, что события нет,
+# и ответит на callback, поэтому тест не меняет данные в Redis
+SAMPLE_UPDATE = {
+    "callback_query": {
+        "id": "1",
+        "chat_instance": "bench",
+        "data": "set_status_going",
+        "from": {"id": 1, "is_bot": False, "first_name": "Bench"},
+        "message": {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": -1, "type": "group", "title": "Bench"},
+            "text": "bench",
+        },
+    },
+}
+
+
+async def read_response(reader: asyncio.StreamReader) -> tuple[int, bool]:
+    """Читает HTTP/1.1 ответ; возвращает код и признак того, что сервер закрывает соединение."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+    content_length = 0
+    closing = False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            content_length = int(value.strip())
+        elif name == b"connection" and value.strip().lower() == b"close":
+            closing = True
+    if content_length:
+        await reader.readexactly(content_length)
+    return status, closing
+
+
+async def run_benchmark(url: str, secret: str, total: int, concurrency: int, junk: bool) -> dict:
+    """
+    Отправляет total запросов через concurrency keep-alive соединений и собирает
+    задержки и коды ответов. Клиент написан на голых asyncio-потоках, чтобы
+    на одной машине с сервером он сам не становился узким местом.
+    """
+    parts = urlsplit(url)
+    host, port, path = parts.hostname, parts.port or 80, parts.path or "/"
+    latencies = []
+    statuses = {}
+    counter = iter(range(total))
+    secret_header = "wrong-secret" if junk else secret
+
+    async def worker() -> None:
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for update_id in counter:
+                body = json.dumps({"update_id": update_id, **SAMPLE_UPDATE}).encode()
+                request = (
+                    f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                    f"X-Telegram-Bot-Api-Secret-Token: {secret_header}\r\nContent-Length: {len(body)}\r\n\r\n"
+                ).encode() + body
+                started = time.perf_counter()
+                try:
+                    writer.write(request)
+                    status, closing = await read_response(reader)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    status, closing = "connection error", True
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+                if closing:
+                    # Сервер закрыл соединение после ответа: переподключаемся
+                    writer.close()
+                    reader, writer = await asyncio.open_connection(host, port)
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "elapsed": elapsed,
+        "rps": total / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "statuses": statuses,
+    }
+
+
+def fake_api_request(base_url: str, path: str, method: str = "GET") -> dict:
+    """Запрос к служебным путям fake_bot_api.py."""
+    with urllib.request.urlopen(urllib.request.Request(f"{base_url}/fake/{path}", method=method)) as response:
+        return json.loads(response.read())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Webhook throughput and latency benchmark.")
+    parser.add_argument("url", help="Full webhook URL, e.g. http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", default="", help="Value of the X-Telegram-Bot-Api-Secret-Token header")
+    parser.add_argument("-n", "--requests", type=int, default=5000, help="Total number of requests")
+    parser.add_argument("-c", "--concurrency", type=int, default=40, help="Parallel connections (Telegram uses up to 40)")
+    parser.add_argument("--junk", action="store_true", help="Send requests with a wrong secret token")
+    parser.add_argument("--api-stats", help="Base URL of fake_bot_api.py to report outbound Bot API calls")
+    args = parser.parse_args()
+
+    if args.api_stats:
+        fake_api_request(args.api_stats, "reset", method="POST")
+    result = asyncio.run(run_benchmark(args.url, args.secret, args.requests, args.concurrency, args.junk))
+    print(
+        f"{result['requests']} requests in {result['elapsed']:.2f}s: {result['rps']:.0f} req/s, "
+        f"p50 {result['p50_ms']:.2f} ms, p95 {result['p95_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, "
+        f"statuses {result['statuses']}"
+    )
+    if args.api_stats:
+        # Обработчики работают асинхронно после ответа 200, поэтому
+        # счетчики снимаются с небольшой задержкой
+        time.sleep(1)
+        for bot_id, stats in fake_api_request(args.api_stats, "stats").items():
+            print(
+                f"bot {bot_id}: {stats['total_calls']} API calls ({stats['total_calls'] / args.requests:.2f} per update), "
+                f"by method {stats['calls']}, errors {stats['errors']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
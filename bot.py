@@ -2,9 +2,9 @@ import logging
 import os
 from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import CallbackQueryHandler
-from datetime import datetime
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyParameters
+from telegram.ext import CallbackQueryHandler, SimpleUpdateProcessor
+from datetime import datetime, timezone
 from telegram.ext import ConversationHandler, MessageHandler, filters
 import html
 import telegram.error
@@ -12,13 +12,48 @@ import math
 import random
 import redis
 import json
+import zlib
+import time
+import asyncio
+import numpy as np
+import hashlib
+import hmac
+import sys
+import csv
+import io
+import tempfile
+import argparse
+import contextlib
+import contextvars
+import signal
+import uvicorn
 
-# Токен бота, полученный от @BotFather
+try:
+    import uvloop # Быстрый цикл событий для вебхука; на Windows недоступен
+except ImportError:
+    uvloop = None
+
+# Enable logging to see what's happening
+# (до первого вызова logging.*: иначе неявная настройка корневого логгера отключает basicConfig)
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+# httpx пишет в INFO каждый запрос к Bot API, включая getUpdates,
+# а apscheduler - каждый запуск задач JobQueue (reminder_job выполняется раз в секунду)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Токен бота, полученный от @BotFather (данные этого бота хранятся в Redis без префикса)
 TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
+# Дополнительные боты в том же процессе (токены через запятую);
+# их ключи Redis получают префикс f"bot:{bot_id}:"
+EXTRA_TOKENS = [token.strip() for token in os.environ.get("TELEGRAM_BOT_TOKENS", "").split(",") if token.strip()]
 
-# Проверяем, что токен был установлен
-if not TOKEN:
-    raise ValueError("TELEGRAM_BOT_TOKEN environment variable not set.")
+# Проверяем, что хотя бы один токен был установлен
+if not TOKEN and not EXTRA_TOKENS:
+    raise ValueError("TELEGRAM_BOT_TOKEN (or TELEGRAM_BOT_TOKENS) environment variable not set.")
 
 # --- НАСТРОЙКА REDIS КЛИЕНТА ---
 REDIS_URL = os.environ.get("REDIS_URL")
@@ -26,10 +61,15 @@ REDIS_URL = os.environ.get("REDIS_URL")
 if not REDIS_URL:
     raise ValueError("REDIS_URL environment variable not set. Please ensure Redis is configured on Render.")
 
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 50))
+
 try:
     # Инициализируем Redis-клиент
     # decode_responses=True позволяет получать строки Python вместо байтов
-    r = redis.from_url(REDIS_URL, decode_responses=True)
+    # Пулы соединений общие для всех ботов процесса и ограничены по размеру
+    r = redis.from_url(REDIS_URL, decode_responses=True, max_connections=REDIS_MAX_CONNECTIONS)
+    # Отдельный клиент без декодирования для бинарных (сжатых) записей архива
+    r_bin = redis.from_url(REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS)
     r.ping() # Проверяем соединение
     logging.info("Successfully connected to Redis.")
 except redis.exceptions.ConnectionError as e:
@@ -38,107 +78,857 @@ except redis.exceptions.ConnectionError as e:
 
 
 # Ключи для хранения данных в Redis
-EVENT_DATA_KEY = "event_data" # Глобальные данные события
-# Теперь chat-специфичные ключи будут использовать форматирование: f"{KEY}:{chat_id}"
-MAIN_MESSAGE_ID_KEY = "main_message_id"
-MAIN_CHAT_ID_KEY = "main_chat_id"
-SHUFFLED_TEAMS_KEY = "shuffled_teams"
-SHUFFLE_ERROR_KEY = "shuffle_error"
+# Каждое событие хранится отдельной записью: f"{EVENT_KEY}:{chat_id}:{event_id}"
+EVENT_KEY = "event"
+# Индекс активных событий чата (hash message_id -> event_id): f"{EVENT_INDEX_KEY}:{chat_id}"
+EVENT_INDEX_KEY = "event_index"
+EVENT_SEQ_KEY = "event_seq" # Счетчик для выдачи ID событий
+EVENT_ARCHIVE_KEY = "event_archive" # Сжатые архивные записи завершенных событий: f"{KEY}:{chat_id}"
+# История совместных игр чата: упакованные массивы, см. record_coplay()
+COPLAY_PLAYERS_KEY = "coplay_players" # int64 user_id игроков: f"{KEY}:{chat_id}"
+COPLAY_MATRIX_KEY = "coplay_matrix" # uint16 счетчики пар, нижний треугольник: f"{KEY}:{chat_id}"
+# Очередь напоминаний (общая для всех чатов) и задачи, взятые в работу, но еще не отправленные
+REMINDER_QUEUE_KEY = "reminder_queue"
+REMINDER_PROCESSING_KEY = "reminder_processing"
+REMINDER_RUN_KEY = "reminder_run" # Прогресс рассылки (hash total/sent/failed): f"{KEY}:{run_id}"
+REMINDER_RUN_SEQ_KEY = "reminder_run_seq"
+REMINDER_COOLDOWN_KEY = "reminder_cooldown" # Защита от повторных напоминаний: f"{KEY}:{chat_id}:{event_id}"
+REMINDER_CHAT_PAUSE_KEY = "reminder_chat_pause" # Чат, ответивший RetryAfter (TTL = retry_after): f"{KEY}:{chat_id}"
+
+# Ключи прежней схемы (одно глобальное событие на все чаты), переносятся migrate_legacy_state()
+LEGACY_EVENT_DATA_KEY = "event_data"
+LEGACY_CHAT_STATE_KEYS = ("main_message_id", "main_chat_id", "shuffled_teams", "shuffle_error")
+
+# Время жизни событий и индексов: продлевается при каждом сохранении,
+# так что истекают только ключи чатов, где ботом давно не пользовались
+CHAT_STATE_TTL_SECONDS = int(os.environ.get("CHAT_STATE_TTL_SECONDS", 30 * 24 * 3600))
+# События без активности дольше этого срока компактизация переносит в архив
+EVENT_IDLE_ARCHIVE_SECONDS = int(os.environ.get("EVENT_IDLE_ARCHIVE_SECONDS", 14 * 24 * 3600))
+# Сколько событий может быть открыто в одном чате одновременно
+MAX_ACTIVE_EVENTS_PER_CHAT = int(os.environ.get("MAX_ACTIVE_EVENTS_PER_CHAT", 5))
+# Сколько последних завершенных событий хранить в архиве каждого чата
+ARCHIVE_MAX_EVENTS_PER_CHAT = int(os.environ.get("ARCHIVE_MAX_EVENTS_PER_CHAT", 100))
+# Архив чата удаляется, если в чате долго не завершалось ни одного события (срок продлевается с каждым архивированием)
+ARCHIVE_TTL_SECONDS = int(os.environ.get("ARCHIVE_TTL_SECONDS", 180 * 24 * 3600))
+# История совместных игр хранится дольше событий и продлевается с каждым завершенным событием
+COPLAY_TTL_SECONDS = int(os.environ.get("COPLAY_TTL_SECONDS", 180 * 24 * 3600))
+# Сколько времени (в секундах) локальный поиск может подбирать составы с ротацией
+ROTATION_TIME_BUDGET_SECONDS = float(os.environ.get("ROTATION_TIME_BUDGET_SECONDS", 0.3))
+# Глобальный лимит отправки напоминаний: Telegram допускает около 30 сообщений в секунду,
+# остаток оставляем для обновления сообщений событий при голосовании
+REMINDER_SENDS_PER_SECOND = int(os.environ.get("REMINDER_SENDS_PER_SECOND", 20))
+# Сколько упоминаний помещать в одно сообщение-напоминание в чате
+REMINDER_MENTIONS_PER_MESSAGE = int(os.environ.get("REMINDER_MENTIONS_PER_MESSAGE", 20))
+# Участники стольких последних архивных событий считаются постоянными игроками чата
+REMINDER_LOOKBACK_EVENTS = int(os.environ.get("REMINDER_LOOKBACK_EVENTS", 4))
+# Не чаще одного напоминания по событию за этот срок
+REMINDER_COOLDOWN_SECONDS = int(os.environ.get("REMINDER_COOLDOWN_SECONDS", 3600))
+REMINDER_RUN_TTL_SECONDS = 7 * 24 * 3600
+# Период фоновой компактизации Redis
+COMPACTION_INTERVAL_SECONDS = int(os.environ.get("COMPACTION_INTERVAL_SECONDS", 6 * 3600))
+SCAN_BATCH_SIZE = 500
+# Сколько архивных записей читать из Redis за один LRANGE при экспорте
+EXPORT_ARCHIVE_CHUNK = 20
+
+# --- НАСТРОЙКИ ВЕБХУКА ---
+# "asgi" - собственный ASGI-сервер (uvicorn), "ptb" - встроенный сервер python-telegram-bot
+WEBHOOK_SERVER = os.environ.get("WEBHOOK_SERVER", "asgi")
+# Путь вебхука вместо токена бота в URL
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram").strip("/")
+# Секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token (для TELEGRAM_BOT_TOKEN).
+# По умолчанию (и для ботов из TELEGRAM_BOT_TOKENS) выводится из токена, чтобы не меняться между перезапусками
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# Максимальное число принятых, но еще не обработанных обновлений (отдельно для каждого бота)
+UPDATE_QUEUE_MAXSIZE = int(os.environ.get("UPDATE_QUEUE_MAXSIZE", 1000))
+# Обновления Telegram намного меньше; все, что больше, отклоняется без чтения
+WEBHOOK_MAX_BODY_BYTES = int(os.environ.get("WEBHOOK_MAX_BODY_BYTES", 1024 * 1024))
+# Telegram держит соединения к вебхуку открытыми, поэтому keep-alive длиннее стандартных 5 секунд
+WEBHOOK_KEEP_ALIVE_SECONDS = int(os.environ.get("WEBHOOK_KEEP_ALIVE_SECONDS", 75))
+# Сколько обновлений одного бота обрабатывается одновременно. 1 сохраняет последовательную
+# обработку (голоса одного события не перезаписывают друг друга) и не дает загруженному
+# боту занять цикл событий больше чем одним обработчиком за раз
+TENANT_CONCURRENT_UPDATES = int(os.environ.get("TENANT_CONCURRENT_UPDATES", 1))
+# Адрес сервера Bot API (по умолчанию api.telegram.org). Для офлайн-тестов
+# можно указать локальный fake_bot_api.py, например http://127.0.0.1:8081
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL", "").rstrip("/")
+# Период записи метрик ботов в лог
+METRICS_LOG_INTERVAL_SECONDS = int(os.environ.get("METRICS_LOG_INTERVAL_SECONDS", 300))
+
+# ID пользователей Telegram, которым доступны служебные команды (через запятую)
+ADMIN_USER_IDS = {int(x) for x in os.environ.get("ADMIN_USER_IDS", "").split(",") if x.strip()}
 
 # --- Функции для работы с Redis ---
-event_data = {} # Глобальная переменная для хранения event_data
+# Префикс ключей бота, для которого выполняется текущий код. Устанавливается
+# TenantUpdateProcessor для обработчиков и bind_tenant для фоновых задач;
+# asyncio.to_thread копирует его в поток вместе с контекстом
+current_key_prefix = contextvars.ContextVar('current_key_prefix', default="")
+
+
+def redis_key(*parts) -> str:
+    """Собирает ключ Redis текущего бота из частей через двоеточие."""
+    return current_key_prefix.get() + ":".join(str(part) for part in parts)
+
+
+def chat_id_from_key(key: str) -> str:
+    """Извлекает chat_id из ключей вида f"{KEY}:{chat_id}" и f"{KEY}:{chat_id}:{event_id}"."""
+    return key[len(current_key_prefix.get()):].split(":")[1]
 
-def load_global_event_data_from_redis():
+
+def new_event(chat_id: int) -> dict:
+    """Создает (но не сохраняет) новое открытое событие в чате."""
+    now = int(time.time())
+    return {
+        'id': int(r.incr(redis_key(EVENT_SEQ_KEY))),
+        'chat_id': chat_id,
+        'status': 'open',
+        'title': None,
+        'participants': {}, # Ключи - user_id в виде строки (как после JSON)
+        'plus_ones': [],
+        'main_message_id': None,
+        'shuffled_teams': [],
+        'shuffled_team_ids': [], # user_id игроков по командам (без +1), для истории совместных игр
+        'shuffle_error': None,
+        'created_at': now,
+        'updated_at': now,
+    }
+
+
+def load_event(chat_id: int, event_id) -> dict | None:
+    """Загружает одно событие чата из Redis."""
+    event_json = r.get(redis_key(EVENT_KEY, chat_id, event_id))
+    return json.loads(event_json) if event_json else None
+
+
+def find_event_by_message(chat_id: int, message_id: int) -> dict | None:
     """
-    Загружает глобальное состояние события (event_data) из Redis.
-    Эта функция вызывается только один раз при старте приложения.
+    Находит событие по ID его главного сообщения: один HGET по индексу чата
+    и один GET самого события, остальные события чата не загружаются.
     """
-    global event_data
-    event_data_json = r.get(EVENT_DATA_KEY)
-    if event_data_json:
-        event_data.update(json.loads(event_data_json))
-        logger.info("Global event data loaded from Redis.")
-    else:
-        logger.info("No global event data found in Redis. Initializing default.")
-        event_data = {
-            'status': 'open',
-            'title': None,
-            'participants': {},
-            'plus_ones': []
-        }
-
-def load_chat_specific_state_for_context(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    index_key = redis_key(EVENT_INDEX_KEY, chat_id)
+    event_id = r.hget(index_key, message_id)
+    if event_id is None:
+        return None
+    event = load_event(chat_id, event_id)
+    if event is None:
+        # Событие истекло по TTL, а запись в индексе осталась
+        r.hdel(index_key, message_id)
+    return event
+
+
+def list_active_events(chat_id: int) -> list[dict]:
+    """Возвращает все активные события чата, от старых к новым."""
+    event_ids = r.hvals(redis_key(EVENT_INDEX_KEY, chat_id))
+    if not event_ids:
+        return []
+    events_json = r.mget([redis_key(EVENT_KEY, chat_id, event_id) for event_id in event_ids])
+    events = [json.loads(event_json) for event_json in events_json if event_json]
+    return sorted(events, key=lambda event: event['created_at'])
+
+
+def save_event(event: dict, previous_message_id: int | None = None) -> None:
+    """
+    Сохраняет событие и обновляет индекс сообщений чата одним pipeline.
+    Каждое сохранение продлевает TTL события и индекса.
+    previous_message_id - прежнее главное сообщение, если событие было отправлено заново.
+    """
+    chat_id = event['chat_id']
+    event['updated_at'] = int(time.time())
+    index_key = redis_key(EVENT_INDEX_KEY, chat_id)
+
+    pipe = r.pipeline(transaction=False)
+    pipe.set(redis_key(EVENT_KEY, chat_id, event['id']), json.dumps(event), ex=CHAT_STATE_TTL_SECONDS)
+    if previous_message_id is not None and previous_message_id != event['main_message_id']:
+        pipe.hdel(index_key, previous_message_id)
+    if event['main_message_id'] is not None:
+        pipe.hset(index_key, event['main_message_id'], event['id'])
+        pipe.expire(index_key, CHAT_STATE_TTL_SECONDS)
+    pipe.execute()
+    logger.info(f"Event {event['id']} saved to Redis for chat {chat_id}.")
+
+
+def finish_event(event: dict) -> bool:
     """
-    Загружает chat-специфичные данные (ID сообщения, команды, ошибки) из Redis
-    и помещает их в context.chat_data для текущего чата.
-    Вызывается в начале каждого обработчика, которому нужны эти данные.
+    Архивирует событие, учитывает его составы в истории совместных игр
+    и удаляет его из активных. Возвращает True, если запись попала в архив.
     """
-    # Если данные уже есть в context.chat_data, не загружаем их снова,
-    # чтобы избежать перезаписи актуальных данных, измененных в рамках одного обновления.
-    if 'main_message_id' in context.chat_data:
-        return 
+    archived = archive_event(event)
+    if event.get('shuffled_team_ids'):
+        record_coplay(event['chat_id'], event['shuffled_team_ids'])
+    pipe = r.pipeline(transaction=False)
+    pipe.delete(redis_key(EVENT_KEY, event['chat_id'], event['id']))
+    if event.get('main_message_id') is not None:
+        pipe.hdel(redis_key(EVENT_INDEX_KEY, event['chat_id']), event['main_message_id'])
+    pipe.execute()
+    logger.info(f"Event {event['id']} finished in chat {event['chat_id']}.")
+    return archived
+
+
+def migrate_legacy_state() -> None:
+    """
+    Переносит данные прежней схемы (одно глобальное event_data и ключи чатов
+    main_message_id/shuffled_teams/shuffle_error) в отдельные события каждого чата.
+    Вызывается при старте; если старых ключей нет, ничего не делает.
+    """
+    legacy_json = r.get(redis_key(LEGACY_EVENT_DATA_KEY))
+    legacy_event = json.loads(legacy_json) if legacy_json else None
+
+    migrated = 0
+    if legacy_event:
+        for batch in scan_key_batches(redis_key(LEGACY_CHAT_STATE_KEYS[0], "*")):
+            for key in batch:
+                chat_id = int(chat_id_from_key(key))
+                main_message_id, shuffled_teams_json, shuffle_error = r.mget(
+                    key,
+                    redis_key(LEGACY_CHAT_STATE_KEYS[2], chat_id),
+                    redis_key(LEGACY_CHAT_STATE_KEYS[3], chat_id),
+                )
+                if not main_message_id:
+                    continue
+                event = new_event(chat_id)
+                event.update(
+                    status=legacy_event.get('status', 'open'),
+                    title=legacy_event.get('title'),
+                    participants={str(user_id): info for user_id, info in legacy_event.get('participants', {}).items()},
+                    plus_ones=legacy_event.get('plus_ones', []),
+                    main_message_id=int(main_message_id),
+                    shuffled_teams=json.loads(shuffled_teams_json) if shuffled_teams_json else [],
+                    shuffle_error=shuffle_error if shuffle_error != 'None' else None,
+                )
+                save_event(event)
+                migrated += 1
+
+    for prefix in LEGACY_CHAT_STATE_KEYS:
+        for batch in scan_key_batches(redis_key(prefix, "*")):
+            r.delete(*batch)
+    r.delete(redis_key(LEGACY_EVENT_DATA_KEY))
+    if migrated:
+        logger.info(f"Migrated legacy event state into {migrated} chat event(s).")
+
+
+# --- Архив завершенных событий ---
+# Статусы в архиве кодируются одной буквой, чтобы холодные записи занимали меньше места
+ARCHIVE_STATUS_CODES = {'going': 'g', 'not_going': 'n', 'maybe': 'm'}
+ARCHIVE_STATUS_NAMES = {code: name for name, code in ARCHIVE_STATUS_CODES.items()}
+
 
-    logger.info(f"Loading chat-specific state for chat {chat_id} from Redis.")
-    
-    # Используем chat_id в ключах Redis
-    main_message_id = r.get(f"{MAIN_MESSAGE_ID_KEY}:{chat_id}")
-    main_chat_id = r.get(f"{MAIN_CHAT_ID_KEY}:{chat_id}")
+def pack_archived_event(event: dict) -> bytes:
+    """
+    Упаковывает завершенное событие в компактную сжатую запись:
+    короткие ключи, без username и пустых полей, JSON без пробелов, zlib.
+    """
+    record = {
+        'i': event.get('id'),
+        't': event.get('title'),
+        'c': event.get('created_at'),
+        'a': int(time.time()),
+        's': event.get('status'),
+        # [user_id, имя, код статуса]; участники без выбранного статуса не сохраняются
+        'p': [
+            [int(user_id), info['name'], ARCHIVE_STATUS_CODES[info['status']]]
+            for user_id, info in event.get('participants', {}).items()
+            if info.get('status') in ARCHIVE_STATUS_CODES
+        ],
+        # +1 хранятся как ID добавившего
+        'x': [entry['added_by_id'] for entry in event.get('plus_ones', [])],
+    }
+    if event.get('shuffled_teams'):
+        record['k'] = event['shuffled_teams']
+    if event.get('shuffled_team_ids'):
+        record['j'] = event['shuffled_team_ids']
+    return zlib.compress(json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode('utf-8'), 9)
+
+
+def unpack_archived_event(blob: bytes) -> dict:
+    """Распаковывает архивную запись, созданную pack_archived_event."""
+    record = json.loads(zlib.decompress(blob))
+    return {
+        'id': record.get('i'),
+        'title': record.get('t'),
+        'created_at': record.get('c'),
+        'archived_at': record.get('a'),
+        'status': record.get('s'),
+        'participants': {
+            str(user_id): {'name': name, 'status': ARCHIVE_STATUS_NAMES[code]}
+            for user_id, name, code in record.get('p', [])
+        },
+        'plus_ones': [{'added_by_id': user_id} for user_id in record.get('x', [])],
+        'shuffled_teams': record.get('k', []),
+        'shuffled_team_ids': record.get('j', []),
+    }
 
-    shuffled_teams_json = r.get(f"{SHUFFLED_TEAMS_KEY}:{chat_id}")
-    # decode_responses=True уже конвертирует "None" в строку "None", а не None
-    shuffle_error = r.get(f"{SHUFFLE_ERROR_KEY}:{chat_id}")
 
-    if main_message_id:
-        context.chat_data['main_message_id'] = int(main_message_id)
-    if main_chat_id:
-        context.chat_data['main_chat_id'] = int(main_chat_id)
-    
-    context.chat_data['shuffled_teams'] = json.loads(shuffled_teams_json) if shuffled_teams_json else []
-    context.chat_data['shuffle_error'] = shuffle_error if shuffle_error != 'None' else None # Преобразуем "None" в None Python
-    logger.info(f"Chat-specific state loaded for chat {chat_id}.")
+def archive_event(event: dict) -> bool:
+    """
+    Переносит событие в холодный архив чата (список сжатых записей, новые в начале).
+    Пустые события (без голосов и +1) не архивируются.
+    """
+    if not any(info.get('status') for info in event.get('participants', {}).values()) and not event.get('plus_ones'):
+        return False
+
+    blob = pack_archived_event(event)
+    archive_key = redis_key(EVENT_ARCHIVE_KEY, event['chat_id'])
+    pipe = r_bin.pipeline(transaction=False)
+    pipe.lpush(archive_key, blob)
+    pipe.ltrim(archive_key, 0, ARCHIVE_MAX_EVENTS_PER_CHAT - 1)
+    pipe.expire(archive_key, ARCHIVE_TTL_SECONDS)
+    pipe.execute()
+    logger.info(f"Event '{event.get('title')}' archived for chat {event['chat_id']} ({len(blob)} bytes).")
+    return True
+
+
+# --- История совместных игр и ротация составов ---
+# Игроки чата нумеруются в порядке первого появления, а счетчик пары (i, j), i > j,
+# лежит в позиции i * (i - 1) // 2 + j. Новый игрок получает следующий номер,
+# и его строка дописывается в конец: обновление не перестраивает массив.
+def _pair_positions(hi: np.ndarray, lo: np.ndarray) -> np.ndarray:
+    """Позиции пар (hi > lo) в упакованном нижнем треугольнике."""
+    return hi * (hi - 1) // 2 + lo
+
+
+def load_coplay(chat_id: int) -> tuple[np.ndarray, np.ndarray]:
+    """Загружает историю совместных игр чата: (user_id игроков, упакованные счетчики пар)."""
+    players_blob, matrix_blob = r_bin.mget(redis_key(COPLAY_PLAYERS_KEY, chat_id), redis_key(COPLAY_MATRIX_KEY, chat_id))
+    players = np.frombuffer(players_blob or b'', dtype='<i8')
+    pairs = np.frombuffer(matrix_blob or b'', dtype='<u2')
+    if len(pairs) != len(players) * (len(players) - 1) // 2:
+        logger.warning(f"Co-play history of chat {chat_id} is inconsistent, ignoring it.")
+        return np.empty(0, dtype='<i8'), np.empty(0, dtype='<u2')
+    return players, pairs
+
+
+def record_coplay(chat_id: int, teams: list[list[int]]) -> None:
+    """
+    Инкрементально добавляет составы одного события в историю совместных игр:
+    новые игроки дописываются в конец, счетчик каждой пары одноклубников растет на 1.
+    Чтение и запись выполняются в транзакции с WATCH, чтобы параллельные
+    завершения событий в одном чате не теряли обновления.
+    """
+    players_key = redis_key(COPLAY_PLAYERS_KEY, chat_id)
+    matrix_key = redis_key(COPLAY_MATRIX_KEY, chat_id)
+
+    def update(pipe):
+        players_blob, matrix_blob = pipe.mget(players_key, matrix_key)
+        players = np.frombuffer(players_blob or b'', dtype='<i8')
+        pairs = np.frombuffer(matrix_blob or b'', dtype='<u2')
+        if len(pairs) != len(players) * (len(players) - 1) // 2:
+            players, pairs = players[:0], pairs[:0]
+
+        position = {int(user_id): i for i, user_id in enumerate(players)}
+        new_players = [user_id for team in teams for user_id in team if user_id not in position]
+        for user_id in new_players:
+            position[user_id] = len(position)
+        total = len(position)
+
+        players = np.concatenate([players, np.array(new_players, dtype='<i8')])
+        pairs = np.concatenate([pairs, np.zeros(total * (total - 1) // 2 - len(pairs), dtype='<u2')])
+
+        for team in teams:
+            idx = np.array([position[user_id] for user_id in team], dtype=np.int64)
+            first, second = np.triu_indices(len(idx), k=1)
+            hi = np.maximum(idx[first], idx[second])
+            lo = np.minimum(idx[first], idx[second])
+            positions = _pair_positions(hi, lo)
+            # Насыщение вместо переполнения uint16
+            pairs[positions] = np.minimum(pairs[positions].astype(np.uint32) + 1, np.iinfo(np.uint16).max)
+
+        pipe.multi()
+        pipe.set(players_key, players.astype('<i8').tobytes(), ex=COPLAY_TTL_SECONDS)
+        pipe.set(matrix_key, pairs.astype('<u2').tobytes(), ex=COPLAY_TTL_SECONDS)
+
+    r_bin.transaction(update, players_key, matrix_key)
+    logger.info(f"Co-play history updated for chat {chat_id} ({sum(len(team) for team in teams)} players).")
+
+
+def coplay_submatrix(chat_id: int, user_ids: list[int | None]) -> np.ndarray:
+    """
+    Возвращает симметричную матрицу совместных игр для указанных игроков
+    (None - игрок без истории, например +1; его строка и столбец нулевые).
+    """
+    players, pairs = load_coplay(chat_id)
+    position = {int(user_id): i for i, user_id in enumerate(players)}
+    idx = np.array([position.get(user_id, -1) if user_id is not None else -1 for user_id in user_ids], dtype=np.int64)
+
+    matrix = np.zeros((len(user_ids), len(user_ids)), dtype=np.int32)
+    known = np.flatnonzero(idx >= 0)
+    if len(known) > 1:
+        known_idx = idx[known]
+        hi = np.maximum.outer(known_idx, known_idx)
+        lo = np.minimum.outer(known_idx, known_idx)
+        positions = np.where(hi == lo, 0, _pair_positions(hi, lo)) # Диагональ обнуляется ниже
+        sub = pairs[positions].astype(np.int32)
+        np.fill_diagonal(sub, 0)
+        matrix[np.ix_(known, known)] = sub
+    return matrix
+
+
+def minimize_repeat_pairings(coplay: np.ndarray, num_teams: int, time_budget: float, seed=None) -> np.ndarray:
+    """
+    Делит игроков на num_teams команд (размеры отличаются не более чем на 1),
+    минимизируя суммарное число прошлых совместных игр внутри команд.
+
+    Локальный поиск с перезапусками: из случайного разбиения на каждом шаге
+    выполняется лучший обмен двух игроков из разных команд. Выигрыш всех n x n
+    обменов считается одной векторной операцией по матрице T[i, t] (сумма
+    совместных игр игрока i с командой t), которая после обмена обновляется
+    за O(n). Работает, пока не истечет time_budget или не найдено разбиение
+    без повторов. Возвращает номер команды для каждого игрока.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(coplay)
+    deadline = time.monotonic() + time_budget
+    rows = np.arange(n)
+    best_assignment, best_cost = None, None
+
+    while True:
+        assignment = np.empty(n, dtype=np.int64)
+        assignment[rng.permutation(n)] = rows % num_teams
+        team_sums = coplay @ np.eye(num_teams, dtype=np.int32)[assignment]
+
+        while time.monotonic() < deadline:
+            own = team_sums[rows, assignment]
+            cross = team_sums[:, assignment] # cross[i, j] = T[i, команда j]
+            gain = cross - own[:, None] + cross.T - own[None, :] - 2 * coplay
+            gain[assignment[:, None] == assignment[None, :]] = 0
+            i, j = np.unravel_index(np.argmin(gain), gain.shape)
+            if gain[i, j] >= 0:
+                break
+            team_i, team_j = assignment[i], assignment[j]
+            team_sums[:, team_i] += coplay[:, j] - coplay[:, i]
+            team_sums[:, team_j] += coplay[:, i] - coplay[:, j]
+            assignment[i], assignment[j] = team_j, team_i
+
+        cost = int(team_sums[rows, assignment].sum()) // 2
+        if best_cost is None or cost < best_cost:
+            best_assignment, best_cost = assignment.copy(), cost
+        if best_cost == 0 or time.monotonic() >= deadline:
+            return best_assignment
+
+
+# --- Напоминания не определившимся участникам ---
+# Задачи рассылки лежат в общей очереди Redis. Обработчик забирает их через LMOVE
+# в список REMINDER_PROCESSING_KEY и удаляет оттуда только после отправки, поэтому
+# после перезапуска невыполненные задачи возвращаются в очередь (recover_reminder_tasks).
+def recent_regulars(chat_id: int) -> dict[str, str]:
+    """Возвращает {user_id: имя} тех, кто шел хотя бы на одно из REMINDER_LOOKBACK_EVENTS последних событий."""
+    regulars = {}
+    for blob in r_bin.lrange(redis_key(EVENT_ARCHIVE_KEY, chat_id), 0, REMINDER_LOOKBACK_EVENTS - 1):
+        for user_id, info in unpack_archived_event(blob)['participants'].items():
+            if info['status'] == 'going':
+                regulars.setdefault(user_id, info['name']) # Архив идет от новых к старым
+    return regulars
+
+
+def find_undecided(event: dict) -> list[tuple[str, str]]:
+    """
+    Возвращает (user_id, имя) не определившихся участников события:
+    ответивших "Thinking" и постоянных игроков чата, которые еще не голосовали.
+    """
+    undecided = [
+        (user_id, info['name'])
+        for user_id, info in event['participants'].items()
+        if info.get('status') in ('maybe', None)
+    ]
+    for user_id, name in recent_regulars(event['chat_id']).items():
+        if user_id not in event['participants']:
+            undecided.append((user_id, name))
+    return undecided
+
+
+def supergroup_message_link(chat_id: int, message_id: int) -> str | None:
+    """Ссылка на сообщение в супергруппе (для обычных групп ссылок не бывает)."""
+    chat_id_str = str(chat_id)
+    if not chat_id_str.startswith("-100"):
+        return None
+    return f"https://t.me/c/{chat_id_str[4:]}/{message_id}"
+
+
+def plan_event_reminders(event: dict, mode: str, run_id: int) -> list[str]:
+    """
+    Готовит задачи рассылки по событию: в режиме "mention" - сообщения в чат события
+    с упоминаниями (до REMINDER_MENTIONS_PER_MESSAGE в каждом), в режиме "dm" -
+    личное сообщение каждому участнику. Возвращает задачи в виде JSON-строк.
+    """
+    undecided = find_undecided(event)
+    if not undecided:
+        return []
+
+    title = html.escape(event['title'] or "Event")
+    if mode == 'dm':
+        link = supergroup_message_link(event['chat_id'], event['main_message_id'])
+        text = f"⏰ Please vote for <b>{title}</b>" + (f': <a href="{link}">open the poll</a>' if link else " in the group chat.")
+        return [json.dumps({'r': run_id, 'c': int(user_id), 't': text}) for user_id, _ in undecided]
+
+    tasks = []
+    for start in range(0, len(undecided), REMINDER_MENTIONS_PER_MESSAGE):
+        mentions = ", ".join(
+            get_clickable_name(user_id, name)
+            for user_id, name in undecided[start:start + REMINDER_MENTIONS_PER_MESSAGE]
+        )
+        tasks.append(json.dumps({
+            'r': run_id,
+            'c': event['chat_id'],
+            'm': event['main_message_id'],
+            't': f"⏰ <b>{title}</b>: please vote!\n{mentions}",
+        }))
+    return tasks
 
 
-def save_event_state(current_main_message_id=None, current_main_chat_id=None,
-                     current_shuffled_teams=None, current_shuffle_error=None):
+def enqueue_reminders(chat_ids, mode: str) -> tuple[int, int]:
+    """
+    Ставит в очередь напоминания по всем открытым событиям указанных чатов.
+    События, по которым напоминали менее REMINDER_COOLDOWN_SECONDS назад, пропускаются.
+    Возвращает (ID рассылки, число поставленных задач).
     """
-    Сохраняет текущее глобальное состояние события и chat-специфичные данные в Redis.
-    Global event_data сохраняется всегда.
-    Chat-специфичные данные сохраняются, если передан current_main_chat_id.
+    run_id = int(r.incr(redis_key(REMINDER_RUN_SEQ_KEY)))
+    run_key = redis_key(REMINDER_RUN_KEY, run_id)
+    r.hset(run_key, mapping={'total': 0, 'sent': 0, 'failed': 0, 'mode': mode, 'created_at': int(time.time())})
+    r.expire(run_key, REMINDER_RUN_TTL_SECONDS)
+
+    total = 0
+    for chat_id in chat_ids:
+        tasks = []
+        for event in list_active_events(chat_id):
+            if event['status'] != 'open' or not event['main_message_id']:
+                continue
+            cooldown_key = redis_key(REMINDER_COOLDOWN_KEY, chat_id, event['id'])
+            if not r.set(cooldown_key, run_id, nx=True, ex=REMINDER_COOLDOWN_SECONDS):
+                continue
+            tasks.extend(plan_event_reminders(event, mode, run_id))
+        if tasks:
+            pipe = r.pipeline(transaction=False)
+            pipe.hincrby(run_key, 'total', len(tasks))
+            pipe.rpush(redis_key(REMINDER_QUEUE_KEY), *tasks)
+            pipe.execute()
+            total += len(tasks)
+
+    logger.info(f"Reminder run {run_id} ({mode}) queued {total} message(s).")
+    return run_id, total
+
+
+def all_chat_ids():
+    """Итерирует ID всех чатов с активными событиями (по индексам сообщений, через SCAN)."""
+    for batch in scan_key_batches(redis_key(EVENT_INDEX_KEY, "*")):
+        for key in batch:
+            yield int(chat_id_from_key(key))
+
+
+def take_reminder_tasks(limit: int) -> list[str]:
     """
-    # Сохраняем event_data (глобальное состояние)
-    r.set(EVENT_DATA_KEY, json.dumps(event_data))
+    Забирает до limit задач из очереди в список обрабатываемых. Задачи чатов,
+    которые сейчас на паузе после RetryAfter, сразу возвращаются в конец очереди,
+    чтобы не занимать места остальных чатов; за один вызов просматривается
+    не больше 5 * limit задач.
+    """
+    tasks = []
+    for _ in range(5):
+        pipe = r.pipeline(transaction=False)
+        for _ in range(limit - len(tasks)):
+            pipe.lmove(redis_key(REMINDER_QUEUE_KEY), redis_key(REMINDER_PROCESSING_KEY), 'LEFT', 'RIGHT')
+        taken = [task for task in pipe.execute() if task is not None]
+        if not taken:
+            break
+
+        chat_ids = [json.loads(task)['c'] for task in taken]
+        pipe = r.pipeline(transaction=False)
+        for chat_id in chat_ids:
+            pipe.exists(redis_key(REMINDER_CHAT_PAUSE_KEY, chat_id))
+        paused = pipe.execute()
+
+        pipe = r.pipeline(transaction=False)
+        for task, is_paused in zip(taken, paused):
+            if is_paused:
+                pipe.lrem(redis_key(REMINDER_PROCESSING_KEY), 1, task)
+                pipe.rpush(redis_key(REMINDER_QUEUE_KEY), task)
+            else:
+                tasks.append(task)
+        pipe.execute()
+        if len(tasks) >= limit:
+            break
+    return tasks
 
-    # Сохраняем chat-специфичные данные, если есть chat_id для их привязки
-    if current_main_chat_id is not None:
-        chat_id = current_main_chat_id
-        if current_main_message_id is not None:
-            r.set(f"{MAIN_MESSAGE_ID_KEY}:{chat_id}", str(current_main_message_id))
+
+def complete_reminder_tasks(tasks: list[str], results: list[tuple[str, float]]) -> None:
+    """
+    Фиксирует результат отправки: задача удаляется из обрабатываемых и учитывается
+    в прогрессе рассылки. Задачи с исходом "retry" возвращаются в конец очереди,
+    а их чат ставится на паузу на указанное время, не задерживая остальные чаты.
+    """
+    pipe = r.pipeline(transaction=False)
+    for task, (outcome, pause) in zip(tasks, results):
+        pipe.lrem(redis_key(REMINDER_PROCESSING_KEY), 1, task)
+        if outcome == 'retry':
+            pipe.rpush(redis_key(REMINDER_QUEUE_KEY), task)
+            if pause:
+                pipe.set(redis_key(REMINDER_CHAT_PAUSE_KEY, json.loads(task)['c']), 1, ex=math.ceil(pause))
         else:
-            r.delete(f"{MAIN_MESSAGE_ID_KEY}:{chat_id}") # Удаляем, если ID сообщения нет
+            pipe.hincrby(redis_key(REMINDER_RUN_KEY, json.loads(task)['r']), outcome, 1)
+    pipe.execute()
 
-        r.set(f"{MAIN_CHAT_ID_KEY}:{chat_id}", str(chat_id))
 
-        if current_shuffled_teams is not None:
-            r.set(f"{SHUFFLED_TEAMS_KEY}:{chat_id}", json.dumps(current_shuffled_teams))
-        else:
-            r.delete(f"{SHUFFLED_TEAMS_KEY}:{chat_id}")
-        
-        if current_shuffle_error is not None:
-            r.set(f"{SHUFFLE_ERROR_KEY}:{chat_id}", current_shuffle_error)
-        else:
-            r.delete(f"{SHUFFLE_ERROR_KEY}:{chat_id}") # Если ошибка была, но теперь ее нет, удаляем ключ
-            
-        logger.info(f"Event state saved to Redis for chat {chat_id}.")
+def recover_reminder_tasks() -> int:
+    """Возвращает в начало очереди задачи, взятые в работу до перезапуска. Вызывается при старте."""
+    recovered = 0
+    while r.lmove(redis_key(REMINDER_PROCESSING_KEY), redis_key(REMINDER_QUEUE_KEY), 'RIGHT', 'LEFT') is not None:
+        recovered += 1
+    if recovered:
+        logger.info(f"Recovered {recovered} unfinished reminder task(s).")
+    return recovered
+
+
+# --- Экспорт истории посещаемости ---
+# Экспорт построен на генераторах: события читаются по одному (SCAN по ключам
+# и LRANGE по архиву частями), строки сразу пишутся в поток, поэтому расход
+# памяти не зависит от объема истории.
+EXPORT_FIELDS = ['chat_id', 'event_id', 'title', 'state', 'event_status', 'created_at', 'archived_at',
+                 'user_id', 'name', 'vote', 'team']
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+
+def _format_timestamp(timestamp) -> str | None:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp else None
+
+
+def event_export_rows(chat_id, event: dict, state: str):
+    """
+    Строки экспорта одного события: по одной на голос и на каждый +1.
+    У каждого поля один тип во всех строках (chat_id и user_id - int); отсутствующие
+    значения - None, которые в CSV записываются пустыми ячейками, а в JSON Lines - null.
+    """
+    team_of = {
+        user_id: team_number
+        for team_number, team in enumerate(event.get('shuffled_team_ids') or [], start=1)
+        for user_id in team
+    }
+    base = {
+        'chat_id': int(chat_id),
+        'event_id': event.get('id'),
+        'title': event.get('title') or '',
+        'state': state,
+        'event_status': event.get('status') or '',
+        'created_at': _format_timestamp(event.get('created_at')),
+        'archived_at': _format_timestamp(event.get('archived_at')),
+    }
+    for user_id, info in event['participants'].items():
+        if info.get('status'):
+            yield {**base, 'user_id': int(user_id), 'name': info['name'], 'vote': info['status'],
+                   'team': team_of.get(int(user_id))}
+    for entry in event['plus_ones']:
+        # В архиве у +1 хранится только ID добавившего, имя берем из его голоса
+        name = entry.get('added_by_name') or event['participants'].get(str(entry['added_by_id']), {}).get('name', '')
+        yield {**base, 'user_id': int(entry['added_by_id']), 'name': name, 'vote': 'plus_one', 'team': None}
+
+
+def iter_archived_events(chat_id):
+    """Итерирует архив чата частями по EXPORT_ARCHIVE_CHUNK записей."""
+    archive_key = redis_key(EVENT_ARCHIVE_KEY, chat_id)
+    start = 0
+    while True:
+        blobs = r_bin.lrange(archive_key, start, start + EXPORT_ARCHIVE_CHUNK - 1)
+        if not blobs:
+            return
+        for blob in blobs:
+            yield unpack_archived_event(blob)
+        start += len(blobs)
+
+
+def iter_export_rows(chat_id: int | None = None):
+    """Строки экспорта активных и архивных событий одного чата или (chat_id=None) всех чатов."""
+    if chat_id is not None:
+        for event in list_active_events(chat_id):
+            yield from event_export_rows(chat_id, event, 'active')
+        for event in iter_archived_events(chat_id):
+            yield from event_export_rows(chat_id, event, 'archived')
+        return
+
+    for batch in scan_key_batches(redis_key(EVENT_KEY, "*")):
+        for key, event_json in zip(batch, r.mget(batch)):
+            if event_json:
+                yield from event_export_rows(chat_id_from_key(key), json.loads(event_json), 'active')
+    for batch in scan_key_batches(redis_key(EVENT_ARCHIVE_KEY, "*")):
+        for key in batch:
+            archive_chat_id = chat_id_from_key(key)
+            for event in iter_archived_events(archive_chat_id):
+                yield from event_export_rows(archive_chat_id, event, 'archived')
+
+
+def write_export(rows, export_format: str, stream) -> int:
+    """Пишет строки экспорта в текстовый поток в формате CSV или JSON Lines. Возвращает число строк."""
+    count = 0
+    if export_format == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
     else:
-        logger.info("Global event data saved to Redis (no chat-specific data provided for saving).")
+        for row in rows:
+            stream.write(json.dumps(row, ensure_ascii=False) + "\n")
+            count += 1
+    return count
 
 
-# Enable logging to see what's happening
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+def export_to_tempfile(chat_id: int | None, export_format: str):
+    """Экспортирует историю во временный файл на диске. Возвращает (бинарный файл в начале, число строк)."""
+    binary_file = tempfile.TemporaryFile()
+    text_stream = io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+    count = write_export(iter_export_rows(chat_id), export_format, text_stream)
+    text_stream.flush()
+    text_stream.detach()
+    binary_file.seek(0)
+    return binary_file, count
+
+
+# --- Компактизация и учет памяти Redis ---
+def scan_key_batches(pattern: str):
+    """
+    Итерирует ключи по шаблону через SCAN (не блокирует Redis, в отличие от KEYS)
+    и отдает их пачками по SCAN_BATCH_SIZE, чтобы обрабатывать их pipeline'ами.
+    """
+    batch = []
+    for key in r.scan_iter(match=pattern, count=SCAN_BATCH_SIZE):
+        batch.append(key)
+        if len(batch) >= SCAN_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def compact_redis() -> dict:
+    """
+    Приводит ключи событий в порядок:
+    - события без активности дольше EVENT_IDLE_ARCHIVE_SECONDS переносит в архив;
+    - ключам без TTL выставляет CHAT_STATE_TTL_SECONDS;
+    - удаляет из индексов записи, указывающие на истекшие события;
+    - обрезает архивы до ARCHIVE_MAX_EVENTS_PER_CHAT записей и выставляет
+      ARCHIVE_TTL_SECONDS архивам без TTL (созданным до его появления).
+    Возвращает счетчики выполненных действий.
+    """
+    stats = {'idle_events_archived': 0, 'expired_set': 0, 'index_entries_removed': 0, 'archives_trimmed': 0}
+    idle_before = time.time() - EVENT_IDLE_ARCHIVE_SECONDS
+
+    for batch in scan_key_batches(redis_key(EVENT_KEY, "*")):
+        pipe = r.pipeline(transaction=False)
+        for key in batch:
+            pipe.ttl(key)
+            pipe.get(key)
+        results = pipe.execute()
+
+        pipe = r.pipeline(transaction=False)
+        for i, key in enumerate(batch):
+            ttl, event_json = results[2 * i:2 * i + 2]
+            if event_json is None:
+                continue # Ключ истек между SCAN и чтением
+            event = json.loads(event_json)
+            if event.get('updated_at', 0) < idle_before:
+                finish_event(event)
+                stats['idle_events_archived'] += 1
+            elif ttl == -1:
+                pipe.expire(key, CHAT_STATE_TTL_SECONDS)
+                stats['expired_set'] += 1
+        pipe.execute()
+
+    for batch in scan_key_batches(redis_key(EVENT_INDEX_KEY, "*")):
+        for key in batch:
+            chat_id = chat_id_from_key(key)
+            index = r.hgetall(key)
+            message_ids = list(index)
+            pipe = r.pipeline(transaction=False)
+            for message_id in message_ids:
+                pipe.exists(redis_key(EVENT_KEY, chat_id, index[message_id]))
+            dangling = [message_id for message_id, exists in zip(message_ids, pipe.execute()) if not exists]
+            if dangling:
+                r.hdel(key, *dangling)
+                stats['index_entries_removed'] += len(dangling)
+            if r.ttl(key) == -1:
+                r.expire(key, CHAT_STATE_TTL_SECONDS)
+                stats['expired_set'] += 1
+
+    for batch in scan_key_batches(redis_key(EVENT_ARCHIVE_KEY, "*")):
+        pipe = r.pipeline(transaction=False)
+        for key in batch:
+            pipe.llen(key)
+            pipe.ttl(key)
+        results = pipe.execute()
+        pipe = r.pipeline(transaction=False)
+        for i, key in enumerate(batch):
+            length, ttl = results[2 * i:2 * i + 2]
+            if length > ARCHIVE_MAX_EVENTS_PER_CHAT:
+                pipe.ltrim(key, 0, ARCHIVE_MAX_EVENTS_PER_CHAT - 1)
+                stats['archives_trimmed'] += 1
+            if ttl == -1:
+                pipe.expire(key, ARCHIVE_TTL_SECONDS)
+                stats['expired_set'] += 1
+        pipe.execute()
+
+    return stats
+
+
+def collect_memory_report() -> dict:
+    """
+    Считает занятую память (MEMORY USAGE) по чатам и по событиям.
+    Для каждого чата суммируются его события, индекс, архив и история совместных игр;
+    для событий считается суммарный размер активных записей и архивов (по LLEN, без чтения записей).
+    """
+    per_chat = {}
+    active_events = 0
+    active_event_bytes = 0
+    archived_events = 0
+    archived_bytes = 0
+
+    for key_name in (EVENT_KEY, EVENT_INDEX_KEY, EVENT_ARCHIVE_KEY, COPLAY_PLAYERS_KEY, COPLAY_MATRIX_KEY):
+        for batch in scan_key_batches(redis_key(key_name, "*")):
+            pipe = r.pipeline(transaction=False)
+            for key in batch:
+                pipe.memory_usage(key)
+                if key_name == EVENT_ARCHIVE_KEY:
+                    pipe.llen(key)
+            results = iter(pipe.execute())
+            for key in batch:
+                used = next(results) or 0
+                chat_id = chat_id_from_key(key)
+                per_chat[chat_id] = per_chat.get(chat_id, 0) + used
+                if key_name == EVENT_KEY:
+                    active_events += 1
+                    active_event_bytes += used
+                elif key_name == EVENT_ARCHIVE_KEY:
+                    # Холодный архив не читается: размер берется из MEMORY USAGE списка
+                    archived_events += next(results)
+                    archived_bytes += used
+
+    info = r.info('memory')
+    return {
+        'used_memory': info.get('used_memory', 0),
+        'used_memory_peak': info.get('used_memory_peak', 0),
+        'active_events': active_events,
+        'active_event_bytes': active_event_bytes,
+        'per_chat': per_chat,
+        'archived_events': archived_events,
+        'archived_bytes': archived_bytes,
+    }
+
+
+def format_memory_report(report: dict, top: int = 10) -> str:
+    """Форматирует отчет collect_memory_report для отправки в чат."""
+    per_chat = report['per_chat']
+    chats_total = sum(per_chat.values())
+    lines = [
+        "📊 Redis memory",
+        f"Used: {report['used_memory']} bytes (peak {report['used_memory_peak']})",
+        f"Active events: {report['active_events']}, {report['active_event_bytes']} bytes"
+        + (f", {report['active_event_bytes'] // report['active_events']} bytes per event on average" if report['active_events'] else ""),
+        f"Chats: {len(per_chat)}, {chats_total} bytes total"
+        + (f", {chats_total // len(per_chat)} bytes per chat on average" if per_chat else ""),
+        f"Archived events: {report['archived_events']}, {report['archived_bytes']} bytes (compressed)"
+        + (f", {report['archived_bytes'] // report['archived_events']} bytes per event on average" if report['archived_events'] else ""),
+    ]
+    if per_chat:
+        lines.append("")
+        lines.append(f"Top {min(top, len(per_chat))} chats by memory:")
+        for chat_id, used in sorted(per_chat.items(), key=lambda item: item[1], reverse=True)[:top]:
+            lines.append(f"{chat_id}: {used} bytes")
+    return "\n".join(lines)
+
 
 # States for ConversationHandler
 TITLE_STATE = range(1)
@@ -151,17 +941,15 @@ def get_clickable_name(user_id: int, user_name: str, username: str = None) -> st
     return f'<a href="tg://user?id={user_id}">{escaped_user_name}</a>'
 
 
-async def get_event_message_and_keyboard(context: ContextTypes.DEFAULT_TYPE) -> tuple[str, InlineKeyboardMarkup]:
-    """Generates the event message text and inline keyboard."""
-    global event_data # Use global event data
-
+async def get_event_message_and_keyboard(event: dict) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Generates the message text and inline keyboard of a single event."""
     direct_going_participants = []
     plus_one_entries_formatted = []
     not_going_list = []
     maybe_list = []
     total_going_count = 0
 
-    for user_id, user_info in event_data['participants'].items():
+    for user_id, user_info in event['participants'].items():
         name = user_info['name']
         status = user_info['status']
         username = user_info.get('username')
@@ -176,7 +964,7 @@ async def get_event_message_and_keyboard(context: ContextTypes.DEFAULT_TYPE) ->
         elif status == 'maybe':
             maybe_list.append(display_name)
 
-    for plus_one_entry in event_data['plus_ones']:
+    for plus_one_entry in event['plus_ones']:
         added_by_id = plus_one_entry['added_by_id']
         added_by_name = plus_one_entry['added_by_name']
         added_by_username = plus_one_entry.get('added_by_username')
@@ -186,7 +974,7 @@ async def get_event_message_and_keyboard(context: ContextTypes.DEFAULT_TYPE) ->
         total_going_count += 1
 
     message_text = ""
-    title_to_display = event_data['title'] if event_data['title'] else "Event Title (Not Set)"
+    title_to_display = event['title'] if event['title'] else "Event Title (Not Set)"
     message_text += f"<b>{html.escape(title_to_display)}</b>\n\n"
 
     message_text += "🟢 Going:\n"
@@ -210,14 +998,13 @@ async def get_event_message_and_keyboard(context: ContextTypes.DEFAULT_TYPE) ->
 
     message_text += "\n" + "=" * 20 + "\n"
     message_text += f"👥 Total Going: {total_going_count}\n"
-    message_text += f"📅 Created: {datetime.now().strftime('%d %B %Y')}\n\n"
+    message_text += f"📅 Created: {datetime.fromtimestamp(event['created_at']).strftime('%d %B %Y')}\n\n"
 
     # --- Add team section if shuffled ---
-    # Теперь берем shuffled_teams и shuffle_error из context.chat_data
-    if 'shuffled_teams' in context.chat_data and context.chat_data['shuffled_teams']:
+    if event['shuffled_teams']:
         message_text += "--- TEAM COMPOSITIONS ---\n"
         team_emojis = ["🔵", "🔴", "🟡", "🟢", "🟣", "⚪"]
-        for i, team in enumerate(context.chat_data['shuffled_teams']):
+        for i, team in enumerate(event['shuffled_teams']):
             emoji = team_emojis[i % len(team_emojis)]
             message_text += f"{emoji} Team {i+1}:\n"
             if team:
@@ -225,12 +1012,17 @@ async def get_event_message_and_keyboard(context: ContextTypes.DEFAULT_TYPE) ->
             else:
                 message_text += "  (Empty)\n"
         message_text += "------------------------\n\n"
-    elif 'shuffle_error' in context.chat_data and context.chat_data['shuffle_error']:
-        message_text += f"\n❗️ {context.chat_data['shuffle_error']}\n\n"
+    elif event['shuffle_error']:
+        message_text += f"\n❗️ {event['shuffle_error']}\n\n"
+
+    # Завершенное событие показывается без кнопок
+    if event['status'] == 'finished':
+        message_text += "🏁 Event finished.\n"
+        return message_text, None
 
     keyboard = []
 
-    if event_data['status'] == 'open':
+    if event['status'] == 'open':
         status_buttons = [
             InlineKeyboardButton("✅ Going", callback_data="set_status_going"),
             InlineKeyboardButton("❌ Not Going", callback_data="set_status_not_going"),
@@ -246,170 +1038,177 @@ async def get_event_message_and_keyboard(context: ContextTypes.DEFAULT_TYPE) ->
         keyboard.append(plus_minus_buttons)
 
     toggle_status_button = InlineKeyboardButton(
-        "⛔ Close Vote" if event_data['status'] == 'open' else "▶️ Open Vote",
-        callback_data="admin_close_collection" if event_data['status'] == 'open' else "admin_open_collection"
+        "⛔ Close Vote" if event['status'] == 'open' else "▶️ Open Vote",
+        callback_data="admin_close_collection" if event['status'] == 'open' else "admin_open_collection"
     )
 
     current_admin_buttons_row = [toggle_status_button]
 
-    if event_data['status'] == 'closed':
+    if event['status'] == 'closed':
         shuffle_button = InlineKeyboardButton("🔀 Shuffle", callback_data="admin_shuffle_teams")
         current_admin_buttons_row.append(shuffle_button)
+        current_admin_buttons_row.append(InlineKeyboardButton("🏁 Finish", callback_data="admin_finish_event"))
 
-    if event_data['status'] == 'open':
+    if event['status'] == 'open':
         current_admin_buttons_row.extend([
             InlineKeyboardButton("✏️ Edit Title", callback_data="admin_set_title")
         ])
 
     keyboard.append(current_admin_buttons_row)
-   
-    # УДАЛЕНО: keyboard.append([InlineKeyboardButton("✨ New Event", callback_data="admin_new_event")])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     return message_text, reply_markup
 
 
-async def send_main_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Sends or edits the main bot message."""
-    chat_id = update.effective_chat.id
-    
-    # *** ВАЖНОЕ ИЗМЕНЕНИЕ: Загрузка chat-специфичных данных в context.chat_data ***
-    load_chat_specific_state_for_context(chat_id, context)
-
-    message_text, reply_markup = await get_event_message_and_keyboard(context)
-
-    main_message_id = context.chat_data.get('main_message_id')
-    main_chat_id = context.chat_data.get('main_chat_id') # Должен быть равен chat_id текущего обновления
-
-    # Если main_message_id не найден в context.chat_data (либо он None), или chat_id не совпадает,
-    # отправляем новое сообщение.
-    if not main_message_id or main_chat_id != chat_id:
-        sent_message = await update.effective_message.reply_html(text=message_text, reply_markup=reply_markup)
-        context.chat_data['main_message_id'] = sent_message.message_id
-        context.chat_data['main_chat_id'] = sent_message.chat_id
-        
-        save_event_state(
-            sent_message.message_id, 
-            sent_message.chat_id,
-            context.chat_data.get('shuffled_teams'),
-            context.chat_data.get('shuffle_error')
+async def send_new_main_message(context: ContextTypes.DEFAULT_TYPE, event: dict,
+                                message_text: str, reply_markup: InlineKeyboardMarkup | None) -> None:
+    """Sends a fresh main message for the event and re-points the message index to it."""
+    sent_message = await context.bot.send_message(
+        chat_id=event['chat_id'],
+        text=message_text,
+        reply_markup=reply_markup,
+        parse_mode='HTML'
+    )
+    previous_message_id = event['main_message_id']
+    event['main_message_id'] = sent_message.message_id
+    save_event(event, previous_message_id=previous_message_id)
+    logger.info(f"New main message sent. ID: {sent_message.message_id} for event {event['id']} in chat {event['chat_id']}")
+
+
+async def send_main_message(context: ContextTypes.DEFAULT_TYPE, event: dict) -> None:
+    """Sends or edits the main message of the given event."""
+    message_text, reply_markup = await get_event_message_and_keyboard(event)
+
+    main_message_id = event['main_message_id']
+    chat_id = event['chat_id']
+
+    # Если у события еще нет главного сообщения, отправляем новое
+    if not main_message_id:
+        await send_new_main_message(context, event, message_text, reply_markup)
+        return
+
+    try:
+        await context.bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=main_message_id,
+            text=message_text,
+            reply_markup=reply_markup,
+            parse_mode='HTML'
         )
-        logger.info(f"New main message sent. ID: {sent_message.message_id} for chat {chat_id}")
-    else:
-        try:
-            await context.bot.edit_message_text(
-                chat_id=main_chat_id, # Используем chat_id из context.chat_data
-                message_id=main_message_id, # Используем message_id из context.chat_data
-                text=message_text,
-                reply_markup=reply_markup,
-                parse_mode='HTML'
-            )
-            logger.info(f"Main message {main_message_id} updated for chat {chat_id}.")
-            
-            save_event_state(
-                main_message_id,
-                main_chat_id,
-                context.chat_data.get('shuffled_teams'),
-                context.chat_data.get('shuffle_error')
-            )
-        except telegram.error.BadRequest as e:
-            if "Message is not modified" in str(e):
-                logger.info(f"Main message {main_message_id} was not modified for chat {chat_id}. Ignoring.")
-                save_event_state( # Все равно сохраняем, чтобы обновить TTL, если он есть
-                    main_message_id, 
-                    main_chat_id,
-                    context.chat_data.get('shuffled_teams'),
-                    context.chat_data.get('shuffle_error')
-                )
-            else:
-                logger.warning(f"Failed to update main message (ID: {main_message_id}, Chat: {main_chat_id}) due to BadRequest: {e}. Sending new message.")
-                sent_message = await update.effective_message.reply_html(text=message_text, reply_markup=reply_markup)
-                context.chat_data['main_message_id'] = sent_message.message_id
-                context.chat_data['main_chat_id'] = sent_message.chat_id
-                
-                save_event_state(
-                    sent_message.message_id, 
-                    context.chat_data.get('main_chat_id'),
-                    context.chat_data.get('shuffled_teams'),
-                    context.chat_data.get('shuffle_error')
-                )
-        except Exception as e:
-            logger.warning(f"An unexpected error occurred while updating the main message (ID: {main_message_id}, Chat: {main_chat_id}): {e}. Sending new message.")
-            sent_message = await update.effective_message.reply_html(text=message_text, reply_markup=reply_markup)
-            context.chat_data['main_message_id'] = sent_message.message_id
-            context.chat_data['main_chat_id'] = sent_message.chat_id
-            
-            save_event_state(
-                sent_message.message_id, 
-                sent_message.chat_id,
-                context.chat_data.get('shuffled_teams'),
-                context.chat_data.get('shuffle_error')
-            )
+        logger.info(f"Main message {main_message_id} of event {event['id']} updated for chat {chat_id}.")
+    except telegram.error.BadRequest as e:
+        if "Message is not modified" in str(e):
+            logger.info(f"Main message {main_message_id} was not modified for chat {chat_id}. Ignoring.")
+        elif event['status'] == 'finished':
+            logger.warning(f"Failed to update finished event message (ID: {main_message_id}, Chat: {chat_id}): {e}")
+        else:
+            logger.warning(f"Failed to update main message (ID: {main_message_id}, Chat: {chat_id}) due to BadRequest: {e}. Sending new message.")
+            await send_new_main_message(context, event, message_text, reply_markup)
+    except Exception as e:
+        if event['status'] == 'finished':
+            logger.warning(f"Failed to update finished event message (ID: {main_message_id}, Chat: {chat_id}): {e}")
+            return
+        logger.warning(f"An unexpected error occurred while updating the main message (ID: {main_message_id}, Chat: {chat_id}): {e}. Sending new message.")
+        await send_new_main_message(context, event, message_text, reply_markup)
+
+
+async def finish_and_render_event(context: ContextTypes.DEFAULT_TYPE, event: dict) -> None:
+    """Archives the event, removes it from the active ones and shows its final state without buttons."""
+    finish_event(event)
+    event['status'] = 'finished'
+    await send_main_message(context, event)
+
+
+async def create_event(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> dict:
+    """Creates a new event in the chat, finishing the oldest ones above MAX_ACTIVE_EVENTS_PER_CHAT."""
+    active_events = list_active_events(chat_id)
+    for old_event in active_events[:max(0, len(active_events) - MAX_ACTIVE_EVENTS_PER_CHAT + 1)]:
+        logger.info(f"Chat {chat_id} reached {MAX_ACTIVE_EVENTS_PER_CHAT} active events, finishing event {old_event['id']}.")
+        await finish_and_render_event(context, old_event)
+    return new_event(chat_id)
+
+
+async def delete_shuffle_prompt(context: ContextTypes.DEFAULT_TYPE, chat_id: int, event_id: int) -> None:
+    """Deletes the temporary 'select the number of teams' message of the event, if any."""
+    temp_message_id = context.chat_data.get('shuffle_prompts', {}).pop(event_id, None)
+    if temp_message_id is None:
+        return
+    try:
+        await context.bot.delete_message(chat_id=chat_id, message_id=temp_message_id)
+    except Exception as e:
+        logger.warning(f"Failed to delete temp shuffle message of event {event_id}: {e}")
+
+
+def get_players_for_shuffle(event: dict) -> list[tuple[int | None, str]]:
+    """
+    Returns (user_id, display name) of everyone going to the event, including +1 entries.
+    +1 entries have no user_id of their own and get None.
+    """
+    all_players_to_shuffle = []
+    for user_id, user_info in event['participants'].items():
+        if user_info['status'] == 'going':
+            all_players_to_shuffle.append((int(user_id), get_clickable_name(user_id, user_info['name'], user_info.get('username'))))
+    for plus_one_entry in event['plus_ones']:
+        added_by_id = plus_one_entry['added_by_id']
+        added_by_name = plus_one_entry['added_by_name']
+        added_by_username = plus_one_entry.get('added_by_username')
+        all_players_to_shuffle.append((None, f"➕ (+1 from {get_clickable_name(added_by_id, added_by_name, added_by_username)})"))
+    return all_players_to_shuffle
 
 
 async def start_command_title_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Entry point for /start to prompt for title and reset event data."""
-    global event_data
+    """Entry point for /start to prompt for the title of a new event."""
     chat_id = update.effective_chat.id
     logger.info(f"'/start' command received from user {update.effective_user.id} in chat {chat_id}.")
 
-    # Reset global event_data for a new event
-    event_data = {
-        'status': 'open',
-        'title': None,
-        'participants': {},
-        'plus_ones': []
-    }
-    
-    # Clear context.chat_data for the current chat
-    context.chat_data.clear()
-
-    # Also clear Redis entries specific to THIS CHAT and global event_data
-    r.delete(EVENT_DATA_KEY) # Global event data
-    r.delete(f"{MAIN_MESSAGE_ID_KEY}:{chat_id}") # Chat-specific
-    r.delete(f"{MAIN_CHAT_ID_KEY}:{chat_id}")    # Chat-specific
-    r.delete(f"{SHUFFLED_TEAMS_KEY}:{chat_id}")  # Chat-specific
-    r.delete(f"{SHUFFLE_ERROR_KEY}:{chat_id}")   # Chat-specific
-    logger.info(f"Event data and message IDs cleared from Redis for new event for chat {chat_id}.")
-
-    await update.message.reply_text("Please enter the event title:")
+    # None означает, что введенное название получит новое событие;
+    # остальные активные события чата при этом не затрагиваются
+    context.chat_data.setdefault('title_targets', {})[update.effective_user.id] = None
+
+    await update.effective_message.reply_text("Please enter the event title:")
     logger.info(f"Prompted user {update.effective_user.id} to enter new title for a new event.")
     return TITLE_STATE
 
 async def set_title_prompt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Entry point for 'Edit Title' button to prompt for title."""
-    # Загружаем chat-специфичные данные
-    load_chat_specific_state_for_context(update.effective_chat.id, context)
+    query = update.callback_query
+    event = find_event_by_message(update.effective_chat.id, query.message.message_id)
+    if event is None:
+        await query.answer("This event is no longer active.")
+        return ConversationHandler.END
 
-    await update.callback_query.answer("Enter new title.")
+    context.chat_data.setdefault('title_targets', {})[update.effective_user.id] = event['id']
+
+    await query.answer("Enter new title.")
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
         text="Please enter the new event title in the chat."
     )
-    logger.info(f"'Edit Title' button pressed by user {update.effective_user.id}. Prompting for title.")
+    logger.info(f"'Edit Title' button pressed by user {update.effective_user.id} for event {event['id']}. Prompting for title.")
     return TITLE_STATE
 
 async def receive_title(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Receives new title from user and updates it."""
-    global event_data
     chat_id = update.effective_chat.id
-    # Загружаем chat-специфичные данные
-    load_chat_specific_state_for_context(chat_id, context)
+    user_id = update.effective_user.id
 
     if update.message and update.message.text:
-        event_data['title'] = update.message.text.strip()
-        
-        save_event_state(
-            context.chat_data.get('main_message_id'),
-            context.chat_data.get('main_chat_id'),
-            context.chat_data.get('shuffled_teams'), 
-            context.chat_data.get('shuffle_error')
-        )
-        await update.message.reply_text(f"Event title updated to: {event_data['title']}")
-        logger.info(f"Event title updated to: '{event_data['title']}' by user {update.effective_user.id}")
+        event_id = context.chat_data.get('title_targets', {}).pop(user_id, None)
+        if event_id is None:
+            event = await create_event(context, chat_id)
+        else:
+            event = load_event(chat_id, event_id)
+            if event is None:
+                await update.message.reply_text("This event is no longer active.")
+                return ConversationHandler.END
+
+        event['title'] = update.message.text.strip()
+        save_event(event)
+        await update.message.reply_text(f"Event title updated to: {event['title']}")
+        logger.info(f"Event {event['id']} title updated to: '{event['title']}' by user {user_id}")
 
-        await send_main_message(update, context)
+        await send_main_message(context, event)
 
         return ConversationHandler.END
     else:
@@ -420,27 +1219,19 @@ async def receive_title(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 async def start_num_teams_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the 'Shuffle' button press, performs checks, and prompts for number of teams with buttons."""
     query = update.callback_query
-    await query.answer()
-
     chat_id = update.effective_chat.id
-    # Загружаем chat-специфичные данные
-    load_chat_specific_state_for_context(chat_id, context)
 
-    if event_data['status'] == 'open':
-        await query.answer("Please close the vote before shuffling teams.")
-        await send_main_message(update, context)
+    event = find_event_by_message(chat_id, query.message.message_id)
+    if event is None:
+        await query.answer("This event is no longer active.")
         return
 
-    all_players_to_shuffle = []
-    for user_id, user_info in event_data['participants'].items():
-        if user_info['status'] == 'going':
-            all_players_to_shuffle.append(get_clickable_name(user_id, user_info['name'], user_info.get('username')))
-    for plus_one_entry in event_data['plus_ones']:
-        added_by_id = plus_one_entry['added_by_id']
-        added_by_name = plus_one_entry['added_by_name']
-        added_by_username = plus_one_entry.get('added_by_username')
-        all_players_to_shuffle.append(f"➕ (+1 from {get_clickable_name(added_by_id, added_by_name, added_by_username)})")
+    if event['status'] == 'open':
+        await query.answer("Please close the vote before shuffling teams.")
+        await send_main_message(context, event)
+        return
 
+    all_players_to_shuffle = get_players_for_shuffle(event)
     total_players = len(all_players_to_shuffle)
 
     if total_players < 2:
@@ -449,272 +1240,196 @@ async def start_num_teams_selection(update: Update, context: ContextTypes.DEFAUL
             error_message = "No players marked as 'Going' to shuffle."
         elif total_players == 1:
             error_message = "Cannot form teams with only one player."
-        
-        context.chat_data['shuffle_error'] = error_message
-        context.chat_data['shuffled_teams'] = []
-        
-        save_event_state(
-            context.chat_data.get('main_message_id'), 
-            context.chat_data.get('main_chat_id'),
-            context.chat_data['shuffled_teams'], 
-            context.chat_data['shuffle_error']
-        )
+
+        event['shuffle_error'] = error_message
+        event['shuffled_teams'] = []
+        event['shuffled_team_ids'] = []
+        save_event(event)
         await query.answer(error_message)
-        await send_main_message(update, context)
+        await send_main_message(context, event)
         return
 
-    context.chat_data['players_for_shuffle'] = all_players_to_shuffle
-    context.chat_data['total_players_for_shuffle'] = total_players
+    await query.answer()
 
     team_buttons = []
     num_cols = 3
-    current_row = []
-    
+
     possible_num_teams_options = [2, 3, 4]
-    
-    for i in possible_num_teams_options:
-        if i <= total_players:
-            current_row.append(InlineKeyboardButton(str(i), callback_data=f"select_teams_{i}"))
-            if len(current_row) == num_cols:
-                team_buttons.append(current_row)
-                current_row = []
-    if current_row:
-        team_buttons.append(current_row)
+
+    # Первый ряд - случайное перемешивание, второй - с ротацией (меньше повторов прошлых составов)
+    for label_prefix, callback_suffix in (("", ""), ("🔁 ", "_rotate")):
+        current_row = []
+        for i in possible_num_teams_options:
+            if i <= total_players:
+                # ID события в callback_data: временное сообщение не входит в индекс сообщений
+                current_row.append(InlineKeyboardButton(f"{label_prefix}{i}", callback_data=f"select_teams_{event['id']}_{i}{callback_suffix}"))
+                if len(current_row) == num_cols:
+                    team_buttons.append(current_row)
+                    current_row = []
+        if current_row:
+            team_buttons.append(current_row)
+
+    # Повторное нажатие Shuffle заменяет прежний запрос количества команд
+    await delete_shuffle_prompt(context, chat_id, event['id'])
 
     reply_markup = InlineKeyboardMarkup(team_buttons)
     temp_message = await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=f"There are {total_players} players available. Please select the number of teams:",
+        chat_id=chat_id,
+        text=(
+            f"There are {total_players} players available. Please select the number of teams.\n"
+            "🔁 - rotate teammates: avoid pairs that often played together before."
+        ),
         reply_markup=reply_markup
     )
-    context.chat_data['temp_shuffle_message_id'] = temp_message.message_id
-    context.chat_data['temp_shuffle_message_chat_id'] = temp_message.chat_id
-    logger.info(f"User {query.from_user.id} initiated shuffle. Prompting for num teams with buttons.")
+    context.chat_data.setdefault('shuffle_prompts', {})[event['id']] = temp_message.message_id
+    logger.info(f"User {query.from_user.id} initiated shuffle of event {event['id']}. Prompting for num teams with buttons.")
 
 
 async def handle_num_teams_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Receives the desired number of teams from button press and performs the shuffle."""
     query = update.callback_query
-    await query.answer()
-
     chat_id = update.effective_chat.id
-    # Загружаем chat-специфичные данные
-    load_chat_specific_state_for_context(chat_id, context)
 
-    selected_teams_str = query.data.replace("select_teams_", "")
+    event_id_str, selected_teams_str, *options = query.data.replace("select_teams_", "").split("_")
+    event_id = int(event_id_str)
     num_teams = int(selected_teams_str)
+    rotate = "rotate" in options
 
-    all_players_to_shuffle = context.chat_data.get('players_for_shuffle', [])
-    total_players = context.chat_data.get('total_players_for_shuffle', 0)
-
-    if not (2 <= num_teams <= total_players):
-        context.chat_data['shuffle_error'] = "Invalid number of teams selected. Please try again."
-        context.chat_data['shuffled_teams'] = []
-        
-        save_event_state(
-            context.chat_data.get('main_message_id'), 
-            context.chat_data.get('main_chat_id'),
-            context.chat_data['shuffled_teams'], 
-            context.chat_data['shuffle_error']
-        )
+    event = load_event(chat_id, event_id)
+    if event is None:
+        await query.answer("This event is no longer active.")
+        await delete_shuffle_prompt(context, chat_id, event_id)
+        return
+
+    # Список игроков строится заново: голоса могли измениться после запроса
+    all_players_to_shuffle = get_players_for_shuffle(event)
+    total_players = len(all_players_to_shuffle)
+
+    if event['status'] != 'closed' or not (2 <= num_teams <= total_players):
+        event['shuffle_error'] = "Invalid number of teams selected. Please try again."
+        event['shuffled_teams'] = []
+        event['shuffled_team_ids'] = []
+        save_event(event)
         await query.answer("Invalid selection.")
-        if 'temp_shuffle_message_id' in context.chat_data and 'temp_shuffle_message_chat_id' in context.chat_data:
-            try:
-                await context.bot.delete_message(
-                    chat_id=context.chat_data['temp_shuffle_message_chat_id'],
-                    message_id=context.chat_data['temp_shuffle_message_id']
-                )
-                del context.chat_data['temp_shuffle_message_id']
-                del context.chat_data['temp_shuffle_message_chat_id']
-            except Exception as e:
-                logger.warning(f"Failed to delete temp shuffle message on invalid selection: {e}")
-        await send_main_message(update, context)
+        await delete_shuffle_prompt(context, chat_id, event_id)
+        await send_main_message(context, event)
         return
 
-    random.shuffle(all_players_to_shuffle)
+    if rotate:
+        coplay = coplay_submatrix(chat_id, [user_id for user_id, _ in all_players_to_shuffle])
+        # Поиск занимает до ROTATION_TIME_BUDGET_SECONDS, поэтому выполняется вне цикла событий
+        assignment = await asyncio.to_thread(minimize_repeat_pairings, coplay, num_teams, ROTATION_TIME_BUDGET_SECONDS)
+    else:
+        random.shuffle(all_players_to_shuffle)
+        assignment = [i % num_teams for i in range(total_players)]
 
     teams = [[] for _ in range(num_teams)]
-    for i, player in enumerate(all_players_to_shuffle):
-        teams[i % num_teams].append(player)
+    team_ids = [[] for _ in range(num_teams)]
+    for (user_id, player), team_index in zip(all_players_to_shuffle, assignment):
+        teams[team_index].append(player)
+        if user_id is not None:
+            team_ids[team_index].append(user_id)
 
-    context.chat_data['shuffled_teams'] = teams
-    context.chat_data['shuffle_error'] = None
+    event['shuffled_teams'] = teams
+    event['shuffled_team_ids'] = team_ids
+    event['shuffle_error'] = None
+    save_event(event)
 
-    save_event_state(
-        context.chat_data.get('main_message_id'), 
-        context.chat_data.get('main_chat_id'),
-        context.chat_data['shuffled_teams'], 
-        context.chat_data['shuffle_error']
-    )
+    await delete_shuffle_prompt(context, chat_id, event_id)
 
-    if 'temp_shuffle_message_id' in context.chat_data and 'temp_shuffle_message_chat_id' in context.chat_data:
-        try:
-            await context.bot.delete_message(
-                chat_id=context.chat_data['temp_shuffle_message_chat_id'],
-                message_id=context.chat_data['temp_shuffle_message_id']
-            )
-        except Exception as e:
-            logger.warning(f"Failed to delete temp shuffle message: {e}")
-        finally:
-            del context.chat_data['temp_shuffle_message_id']
-            del context.chat_data['temp_shuffle_message_chat_id']
-
-    if 'players_for_shuffle' in context.chat_data:
-        del context.chat_data['players_for_shuffle']
-    if 'total_players_for_shuffle' in context.chat_data:
-        del context.chat_data['total_players_for_shuffle']
-
-    await send_main_message(update, context)
+    await send_main_message(context, event)
     await query.answer(f"Teams shuffled into {num_teams} teams!")
-    logger.info(f"Teams shuffled into {num_teams} teams by user {query.from_user.id}.")
+    logger.info(f"Event {event_id} shuffled into {num_teams} teams (rotate={rotate}) by user {query.from_user.id}.")
 
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles inline button presses that are not part of ConversationHandlers."""
+    """Handles inline button presses on an event message that are not part of ConversationHandlers."""
     query = update.callback_query
     data = query.data
     chat_id = update.effective_chat.id
     logger.info(f"button_callback called with data: {data} from user {query.from_user.id} in chat {chat_id}")
 
-    await query.answer()
+    # Событие определяется по сообщению, на котором нажата кнопка
+    event = find_event_by_message(chat_id, query.message.message_id)
+    if event is None:
+        await query.answer("This event is no longer active.")
+        return
 
-    user_id = query.from_user.id
+    user_id = str(query.from_user.id) # Ключи participants - строки, как после JSON
     user_name = query.from_user.full_name
     username = query.from_user.username
 
-    # *** ВАЖНОЕ ИЗМЕНЕНИЕ: Загрузка chat-специфичных данных в context.chat_data ***
-    load_chat_specific_state_for_context(chat_id, context)
-
     # Initialize user if not in participants, including username
-    if user_id not in event_data['participants']:
-        event_data['participants'][user_id] = {'name': user_name, 'status': None, 'username': username}
+    if user_id not in event['participants']:
+        event['participants'][user_id] = {'name': user_name, 'status': None, 'username': username}
     else: # Update name/username in case it changed
-        event_data['participants'][user_id]['name'] = user_name
-        event_data['participants'][user_id]['username'] = username
-
-
-    # Clear shuffle data for any action except specific shuffle flows
-    if not (data == "admin_shuffle_teams" or data.startswith("select_teams_")):
-        context.chat_data['shuffled_teams'] = []
-        context.chat_data['shuffle_error'] = None
-        
-        save_event_state(
-            context.chat_data.get('main_message_id'),
-            context.chat_data.get('main_chat_id'),
-            context.chat_data['shuffled_teams'], 
-            context.chat_data['shuffle_error']
-        )
-        if 'temp_shuffle_message_id' in context.chat_data:
-            try:
-                await context.bot.delete_message(
-                    chat_id=context.chat_data['temp_shuffle_message_chat_id'],
-                    message_id=context.chat_data['temp_shuffle_message_id']
-                )
-            except Exception as e:
-                logger.warning(f"Failed to delete temp shuffle message on other button press: {e}")
-            finally:
-                del context.chat_data['temp_shuffle_message_id']
-                del context.chat_data['temp_shuffle_message_chat_id']
-                if 'players_for_shuffle' in context.chat_data: del context.chat_data['players_for_shuffle']
-                if 'total_players_for_shuffle' in context.chat_data: del context.chat_data['total_players_for_shuffle']
-
-
-    # Handle 'New Event' button (THIS BLOCK IS NOW OBSOLETE AS BUTTON IS REMOVED, BUT LOGIC REMAINS IF DATA IS SENT)
-    if data == "admin_new_event":
-        # Запускаем команду /start через ее обработчик, чтобы выполнить всю логику сброса
-        await start_command_title_entry(update, context)
-        return # Выходим, так как start_command_title_entry сам обновит/отправит сообщение
+        event['participants'][user_id]['name'] = user_name
+        event['participants'][user_id]['username'] = username
+
+    # Clear shuffle data for any action on the event except finishing it
+    if data != "admin_finish_event":
+        event['shuffled_teams'] = []
+        event['shuffled_team_ids'] = []
+        event['shuffle_error'] = None
+    await delete_shuffle_prompt(context, chat_id, event['id'])
+
+    answer_text = None
+
+    if data == "admin_finish_event":
+        # Пустой участник, добавленный выше только из-за нажатия, в архив не попадает
+        if event['participants'][user_id]['status'] is None:
+            del event['participants'][user_id]
+        await query.answer("Event finished and archived.")
+        await finish_and_render_event(context, event)
+        return
 
     # Check for vote status
-    if event_data['status'] == 'closed' and not data.startswith("admin_"):
-        await query.answer("Vote is closed, participation is unavailable.")
-        await send_main_message(update, context)
-        return
+    if event['status'] == 'closed' and not data.startswith("admin_"):
+        answer_text = "Vote is closed, participation is unavailable."
 
     # Handle status selection
-    if data.startswith("set_status_"):
+    elif data.startswith("set_status_"):
         new_status = data.replace("set_status_", "")
-        event_data['participants'][user_id]['status'] = new_status
-        event_data['participants'][user_id]['username'] = username
-        
-        save_event_state(
-            context.chat_data.get('main_message_id'), 
-            context.chat_data.get('main_chat_id'),
-            context.chat_data.get('shuffled_teams'), 
-            context.chat_data.get('shuffle_error')
-        )
+        event['participants'][user_id]['status'] = new_status
+        event['participants'][user_id]['username'] = username
 
     elif data == "add_plus_one":
-        event_data['plus_ones'].append({
-            'added_by_id': user_id,
+        event['plus_ones'].append({
+            'added_by_id': query.from_user.id,
             'added_by_name': user_name,
             'added_by_username': username
         })
-        
-        save_event_state(
-            context.chat_data.get('main_message_id'),
-            context.chat_data.get('main_chat_id'),
-            context.chat_data.get('shuffled_teams'), 
-            context.chat_data.get('shuffle_error')
-        )
     elif data == "remove_plus_one":
         found_and_removed = False
-        for i in range(len(event_data['plus_ones']) - 1, -1, -1):
-            if event_data['plus_ones'][i]['added_by_id'] == user_id:
-                del event_data['plus_ones'][i]
+        for i in range(len(event['plus_ones']) - 1, -1, -1):
+            if event['plus_ones'][i]['added_by_id'] == query.from_user.id:
+                del event['plus_ones'][i]
                 found_and_removed = True
                 break
         if not found_and_removed:
-            await query.answer("Cannot decrease, as you have no additional participants.")
-        else:
-            
-            save_event_state(
-                context.chat_data.get('main_message_id'),
-                context.chat_data.get('main_chat_id'),
-                context.chat_data.get('shuffled_teams'), 
-                context.chat_data.get('shuffle_error')
-            )
+            answer_text = "Cannot decrease, as you have no additional participants."
 
     elif data == "reset_my_status":
-        if user_id in event_data['participants']:
-            del event_data['participants'][user_id]
-        event_data['plus_ones'] = [
-            entry for entry in event_data['plus_ones']
-            if entry['added_by_id'] != user_id
+        if user_id in event['participants']:
+            del event['participants'][user_id]
+        event['plus_ones'] = [
+            entry for entry in event['plus_ones']
+            if entry['added_by_id'] != query.from_user.id
         ]
-        
-        save_event_state(
-            context.chat_data.get('main_message_id'), 
-            context.chat_data.get('main_chat_id'),
-            context.chat_data.get('shuffled_teams'), 
-            context.chat_data.get('shuffle_error')
-        )
 
     # Handle admin commands
     elif data == "admin_close_collection":
-        event_data['status'] = 'closed'
-        
-        save_event_state(
-            context.chat_data.get('main_message_id'), 
-            context.chat_data.get('main_chat_id'),
-            context.chat_data.get('shuffled_teams'), 
-            context.chat_data.get('shuffle_error')
-        )
-        await query.answer("Vote closed!")
+        event['status'] = 'closed'
+        answer_text = "Vote closed!"
     elif data == "admin_open_collection":
-        event_data['status'] = 'open'
-        
-        save_event_state(
-            context.chat_data.get('main_message_id'), 
-            context.chat_data.get('main_chat_id'),
-            context.chat_data.get('shuffled_teams'), 
-            context.chat_data.get('shuffle_error')
-        )
-        await query.answer("Vote opened!")
-    
-    # If this was not 'admin_new_event' or shuffle-related (which handle send_main_message internally)
-    if not (data == "admin_new_event" or data == "admin_shuffle_teams" or data.startswith("select_teams_")):
-        await send_main_message(update, context)
+        event['status'] = 'open'
+        answer_text = "Vote opened!"
+
+    # Одно сохранение события на нажатие
+    save_event(event)
+    await query.answer(answer_text)
+    await send_main_message(context, event)
+
 
 # --- НОВЫЙ ХЕНДЛЕР: Ошибка при запуске ConversationHandler ---
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -728,43 +1443,459 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a message when the command /help is issued."""
-    chat_id = update.effective_chat.id
-    # Загружаем chat-специфичные данные
-    load_chat_specific_state_for_context(chat_id, context)
-    
     logger.info(f"'/help' command received from user {update.effective_user.id}.")
     await update.message.reply_text(
         "Я бот для сбора на футбол!\n"
         "Используйте /start для начала нового события.\n"
-        "Нажмите кнопки, чтобы указать свое участие или управлять событием."
+        "В одном чате можно вести несколько событий одновременно.\n"
+        "Нажмите кнопки, чтобы указать свое участие или управлять событием.\n"
+        "Администраторы чата могут напомнить не определившимся: /remind (или /remind dm - в личные сообщения)."
+    )
+
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Sends the Redis memory accounting report (bytes per chat and per event) to bot admins."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("Эта команда доступна только администраторам бота.")
+        return
+
+    logger.info(f"'/memory' command received from user {update.effective_user.id}.")
+    # SCAN по всем ключам может занять время, поэтому не блокируем цикл событий
+    report = await asyncio.to_thread(collect_memory_report)
+    await update.message.reply_text(format_memory_report(report))
+
+
+async def compaction_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая задача: компактизирует ключи событий бота и логирует расход памяти."""
+    tenant = bind_tenant(context)
+    started = time.monotonic()
+    stats = await asyncio.to_thread(compact_redis)
+    report = await asyncio.to_thread(collect_memory_report)
+    logger.info(
+        f"Redis compaction for bot {tenant.bot_id} finished in {time.monotonic() - started:.2f}s: {stats}. "
+        f"Used memory: {report['used_memory']} bytes, chats: {len(report['per_chat'])}, "
+        f"active events: {report['active_events']} ({report['active_event_bytes']} bytes), "
+        f"archived events: {report['archived_events']} ({report['archived_bytes']} bytes)."
+    )
+
+
+async def is_chat_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """True для администраторов бота (ADMIN_USER_IDS), администраторов группы и в личном чате."""
+    if update.effective_user.id in ADMIN_USER_IDS or update.effective_chat.type == 'private':
+        return True
+    member = await context.bot.get_chat_member(update.effective_chat.id, update.effective_user.id)
+    return member.status in ('creator', 'administrator')
+
+
+async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /remind [dm] - напомнить не определившимся участникам открытых событий этого чата
+    (упоминаниями в чате или, с dm, в личных сообщениях);
+    /remind all [dm] - то же по всем чатам (только для ADMIN_USER_IDS);
+    /remind status <run_id> - прогресс рассылки.
+    """
+    args = [arg.lower() for arg in context.args]
+    logger.info(f"'/remind {' '.join(args)}' command received from user {update.effective_user.id}.")
+
+    if args[:1] == ['status']:
+        run = r.hgetall(redis_key(REMINDER_RUN_KEY, args[1])) if len(args) > 1 and args[1].isdigit() else {}
+        if not run:
+            await update.message.reply_text("Usage: /remind status <run id> (runs are kept for 7 days).")
+            return
+        pending = int(run['total']) - int(run['sent']) - int(run['failed'])
+        await update.message.reply_text(
+            f"Reminder run #{args[1]} ({run['mode']}): {run['sent']} sent, {run['failed']} failed, "
+            f"{pending} pending of {run['total']}."
+        )
+        return
+
+    mode = 'dm' if 'dm' in args else 'mention'
+    if 'all' in args:
+        if update.effective_user.id not in ADMIN_USER_IDS:
+            await update.message.reply_text("Эта команда доступна только администраторам бота.")
+            return
+        chat_ids = all_chat_ids()
+    else:
+        if not await is_chat_admin(update, context):
+            await update.message.reply_text("Только администраторы чата могут отправлять напоминания.")
+            return
+        chat_ids = [update.effective_chat.id]
+
+    # Планирование по всем чатам читает Redis через SCAN, поэтому выполняется вне цикла событий
+    run_id, total = await asyncio.to_thread(enqueue_reminders, chat_ids, mode)
+    if total:
+        await update.message.reply_text(
+            f"Queued {total} reminder message(s), run #{run_id}. Check progress with /remind status {run_id}."
+        )
+    else:
+        await update.message.reply_text("Nobody to remind: no open events with undecided players (or reminded recently).")
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/export [csv|jsonl] - отправляет историю событий, голосов и составов этого чата документом."""
+    args = [arg.lower() for arg in context.args]
+    export_format = args[0] if args else 'csv'
+    if export_format not in EXPORT_FORMATS:
+        await update.message.reply_text("Usage: /export [csv|jsonl]")
+        return
+    if not await is_chat_admin(update, context):
+        await update.message.reply_text("Только администраторы чата могут выгружать историю.")
+        return
+
+    chat_id = update.effective_chat.id
+    logger.info(f"'/export {export_format}' command received from user {update.effective_user.id} in chat {chat_id}.")
+    export_file, count = await asyncio.to_thread(export_to_tempfile, chat_id, export_format)
+    with export_file:
+        if not count:
+            await update.message.reply_text("Nothing to export yet.")
+            return
+        await context.bot.send_document(
+            chat_id=chat_id,
+            document=export_file,
+            filename=f"attendance_{chat_id}_{datetime.now(timezone.utc).strftime('%Y%m%d')}.{export_format}",
+            caption=f"{count} row(s)",
+        )
+
+
+async def send_reminder(bot, task: str) -> tuple[str, float]:
+    """Отправляет одну задачу рассылки. Возвращает исход (sent/failed/retry) и паузу перед следующими отправками."""
+    payload = json.loads(task)
+    try:
+        await bot.send_message(
+            chat_id=payload['c'],
+            text=payload['t'],
+            parse_mode='HTML',
+            reply_parameters=ReplyParameters(payload['m'], allow_sending_without_reply=True) if payload.get('m') else None,
+        )
+        return 'sent', 0
+    except telegram.error.RetryAfter as e:
+        return 'retry', e.retry_after
+    except (telegram.error.Forbidden, telegram.error.BadRequest) as e:
+        # Пользователь не запускал бота, заблокировал его или чат недоступен: повтор не поможет
+        logger.info(f"Reminder to {payload['c']} failed: {e}")
+        return 'failed', 0
+    except telegram.error.TelegramError as e:
+        logger.warning(f"Reminder to {payload['c']} will be retried: {e}")
+        return 'retry', 5
+
+
+async def reminder_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Раз в секунду отправляет до REMINDER_SENDS_PER_SECOND напоминаний из общей очереди.
+    Работает отдельно от обработки обновлений, поэтому рассылка не задерживает голосование.
+    RetryAfter от одного чата (лимит 20 сообщений в минуту в группе) ставит на паузу
+    только этот чат. Вся рассылка бота приостанавливается, лишь когда RetryAfter
+    вернули несколько чатов и ни одно сообщение не ушло - это общий лимит бота.
+    """
+    bind_tenant(context)
+    if time.monotonic() < context.bot_data.get('reminders_paused_until', 0):
+        return
+
+    tasks = await asyncio.to_thread(take_reminder_tasks, REMINDER_SENDS_PER_SECOND)
+    if not tasks:
+        return
+
+    results = await asyncio.gather(*(send_reminder(context.bot, task) for task in tasks))
+    outcomes = [outcome for outcome, _ in results]
+    retry_chats = {json.loads(task)['c'] for task, (outcome, _) in zip(tasks, results) if outcome == 'retry'}
+    if len(retry_chats) > 1 and 'sent' not in outcomes:
+        pause = max(delay for _, delay in results)
+        context.bot_data['reminders_paused_until'] = time.monotonic() + pause
+        logger.warning(f"Reminder sending paused for {pause} s.")
+    elif retry_chats:
+        logger.info(f"Reminders to {len(retry_chats)} chat(s) paused after RetryAfter.")
+    await asyncio.to_thread(complete_reminder_tasks, tasks, results)
+    logger.info(f"Reminder job: {outcomes.count('sent')} sent, {outcomes.count('failed')} failed, {outcomes.count('retry')} to retry.")
+
+
+# --- НЕСКОЛЬКО БОТОВ В ОДНОМ ПРОЦЕССЕ ---
+class Tenant:
+    """
+    Один бот (токен), обслуживаемый процессом. У каждого бота свой Application,
+    свой префикс ключей Redis, свой путь и секрет вебхука и свои метрики;
+    пулы соединений Redis, цикл событий и HTTP-сервер общие.
+    """
+
+    def __init__(self, token: str, legacy: bool = False):
+        self.token = token
+        self.bot_id = token.split(":")[0]
+        if legacy:
+            # Бот из TELEGRAM_BOT_TOKEN сохраняет прежние ключи, путь и секрет
+            self.key_prefix = ""
+            self.webhook_path = f"/{WEBHOOK_PATH}"
+            self.webhook_secret = WEBHOOK_SECRET or hashlib.sha256(token.encode()).hexdigest()
+        else:
+            self.key_prefix = f"bot:{self.bot_id}:"
+            self.webhook_path = f"/{WEBHOOK_PATH}/{self.bot_id}"
+            self.webhook_secret = hashlib.sha256(token.encode()).hexdigest()
+        self.application = None
+        self.raw_updates = asyncio.Queue(maxsize=UPDATE_QUEUE_MAXSIZE)
+        self.metrics = {
+            'received': 0,
+            'rejected': 0,
+            'queue_full': 0,
+            'processed': 0,
+            'errors': 0,
+            'processing_seconds': 0.0,
+            'max_processing_seconds': 0.0,
+        }
+
+
+def build_tenants() -> list[Tenant]:
+    """Создает ботов из TELEGRAM_BOT_TOKEN и TELEGRAM_BOT_TOKENS (повторы токенов пропускаются)."""
+    tenants = [Tenant(TOKEN, legacy=True)] if TOKEN else []
+    for token in EXTRA_TOKENS:
+        if all(tenant.token != token for tenant in tenants):
+            tenants.append(Tenant(token))
+    return tenants
+
+
+# Все боты процесса (заполняется в main, используется командой /stats)
+TENANTS: list[Tenant] = []
+
+
+@contextlib.contextmanager
+def tenant_scope(tenant: Tenant):
+    """Выполняет блок с ключами Redis указанного бота."""
+    token = current_key_prefix.set(tenant.key_prefix)
+    try:
+        yield
+    finally:
+        current_key_prefix.reset(token)
+
+
+def bind_tenant(context: ContextTypes.DEFAULT_TYPE) -> Tenant:
+    """
+    Привязывает текущую задачу JobQueue к ключам Redis ее бота.
+    Каждая задача выполняется в отдельной asyncio-задаче, поэтому сбрасывать префикс не нужно.
+    """
+    tenant = context.bot_data['tenant']
+    current_key_prefix.set(tenant.key_prefix)
+    return tenant
+
+
+class TenantUpdateProcessor(SimpleUpdateProcessor):
+    """
+    Обрабатывает обновления одного бота: устанавливает префикс ключей Redis
+    на время обработки и собирает метрики. Число одновременно обрабатываемых
+    обновлений ограничено для каждого бота отдельно, поэтому поток обновлений
+    одного бота не отнимает обработчики у остальных.
+    """
+
+    def __init__(self, tenant: Tenant, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.tenant = tenant
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        metrics = self.tenant.metrics
+        started = time.monotonic()
+        with tenant_scope(self.tenant):
+            await coroutine
+        elapsed = time.monotonic() - started
+        metrics['processed'] += 1
+        metrics['processing_seconds'] += elapsed
+        metrics['max_processing_seconds'] = max(metrics['max_processing_seconds'], elapsed)
+
+
+def format_tenant_metrics(tenant: Tenant) -> str:
+    """Одна строка с метриками бота."""
+    metrics = tenant.metrics
+    average_ms = metrics['processing_seconds'] / metrics['processed'] * 1000 if metrics['processed'] else 0
+    queued = tenant.application.update_queue.qsize() if tenant.application else 0
+    return (
+        f"bot {tenant.bot_id}: received {metrics['received']}, rejected {metrics['rejected']}, "
+        f"queue full {metrics['queue_full']}, processed {metrics['processed']}, errors {metrics['errors']}, "
+        f"avg {average_ms:.1f} ms, max {metrics['max_processing_seconds'] * 1000:.1f} ms, "
+        f"queued {tenant.raw_updates.qsize()}+{queued}"
     )
 
+
+async def metrics_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодически записывает метрики бота в лог."""
+    logger.info(f"Metrics: {format_tenant_metrics(bind_tenant(context))}")
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Sends per-bot update metrics of this process to bot admins."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("Эта команда доступна только администраторам бота.")
+        return
+
+    logger.info(f"'/stats' command received from user {update.effective_user.id}.")
+    await update.message.reply_text("\n".join(format_tenant_metrics(tenant) for tenant in TENANTS))
+
+
 async def post_init(application: Application) -> None:
     """
     Выполняется после инициализации Application и установки вебхука.
     Используется для начальной настройки, которая требует объекта bot.
     """
+    tenant = application.bot_data['tenant']
     # Если вы используете вебхуки, убедитесь, что WEBHOOK_URL установлен
     WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
     if WEBHOOK_URL:
         # Получаем текущую информацию о вебхуке
         webhook_info = await application.bot.get_webhook_info()
-        logger.info(f"Current webhook info: {webhook_info}")
-        
-        # Устанавливаем вебхук, только если он отличается от текущего
-        expected_webhook_url = f"{WEBHOOK_URL}/{TOKEN}"
-        if webhook_info.url != expected_webhook_url:
-            await application.bot.set_webhook(url=expected_webhook_url)
-            logger.info(f"Webhook set to: {expected_webhook_url}")
-        else:
-            logger.info(f"Webhook is already set to: {expected_webhook_url}")
+        logger.info(f"Current webhook info for bot {tenant.bot_id}: {webhook_info}")
+
+        # Устанавливаем вебхук при каждом запуске: по getWebhookInfo нельзя
+        # проверить, совпадает ли секрет, а только URL
+        expected_webhook_url = f"{WEBHOOK_URL}{tenant.webhook_path}"
+        await application.bot.set_webhook(url=expected_webhook_url, secret_token=tenant.webhook_secret)
+        logger.info(f"Webhook for bot {tenant.bot_id} set to: {expected_webhook_url}")
     else:
-        logger.info("Running in polling mode (no WEBHOOK_URL set).")
+        logger.info(f"Bot {tenant.bot_id} is running in polling mode (no WEBHOOK_URL set).")
+
+
+class WebhookIngress:
+    """
+    Минимальное ASGI-приложение для приема обновлений Telegram всех ботов процесса.
+
+    Запрос направляется боту по пути и отклоняется по методу, секрету этого бота
+    и Content-Length еще до чтения тела. Принятое тело кладется в ограниченную
+    очередь бота как есть, и сразу отдается 200; JSON разбирается позже,
+    в pump_updates, который передает обновления в Application бота.
+    Если очередь заполнена, возвращается 503, и Telegram повторит доставку.
+    """
+
+    def __init__(self, tenants: list[Tenant]):
+        self.routes = {tenant.webhook_path: (tenant, tenant.webhook_secret.encode()) for tenant in tenants}
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            return
+        route = self.routes.get(scope['path'])
+        if route is None:
+            await self._respond(send, 404)
+            return
+        if scope['method'] != 'POST':
+            await self._respond(send, 405)
+            return
+        tenant, expected_secret = route
+
+        secret_token = None
+        content_length = None
+        for name, value in scope['headers']:
+            if name == b'x-telegram-bot-api-secret-token':
+                secret_token = value
+            elif name == b'content-length':
+                content_length = int(value) if value.isdigit() else -1
+        if secret_token is None or not hmac.compare_digest(secret_token, expected_secret):
+            tenant.metrics['rejected'] += 1
+            await self._respond(send, 403)
+            return
+        # Telegram всегда передает Content-Length: запрос без него (например, chunked) получает 411
+        if content_length is None:
+            status = 411
+        elif content_length < 0:
+            status = 400
+        elif content_length > WEBHOOK_MAX_BODY_BYTES:
+            status = 413
+        else:
+            status = None
+        if status is not None:
+            tenant.metrics['rejected'] += 1
+            await self._respond(send, status)
+            return
+        if tenant.raw_updates.full():
+            tenant.metrics['queue_full'] += 1
+            logger.warning(f"Update queue of bot {tenant.bot_id} is full, asking Telegram to retry later.")
+            await self._respond(send, 503)
+            return
+
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if len(body) > content_length:
+                tenant.metrics['rejected'] += 1
+                await self._respond(send, 413)
+                return
+
+        try:
+            tenant.raw_updates.put_nowait(body)
+        except asyncio.QueueFull:
+            tenant.metrics['queue_full'] += 1
+            await self._respond(send, 503)
+            return
+        tenant.metrics['received'] += 1
+        await self._respond(send, 200)
+
+    @staticmethod
+    async def _respond(send, status: int) -> None:
+        await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-length', b'0')]})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    async def pump_updates(tenant: Tenant) -> None:
+        """Разбирает принятые тела и передает обновления в очередь Application бота."""
+        application = tenant.application
+        while True:
+            body = await tenant.raw_updates.get()
+            try:
+                update = Update.de_json(json.loads(body), application.bot)
+            except Exception as e:
+                logger.warning(f"Dropping malformed webhook update for bot {tenant.bot_id}: {e}")
+                continue
+            # Очередь Application тоже ограничена: если обработчики не успевают,
+            # ожидание здесь заполняет raw_updates, и вебхук начинает отвечать 503
+            await application.update_queue.put(update)
+
+
+async def run_tenants(tenants: list[Tenant], webhook: bool) -> None:
+    """
+    Запускает Application всех ботов в одном цикле событий. В режиме вебхука
+    обновления принимает общий WebhookIngress на uvicorn, иначе каждый бот
+    получает обновления через long polling.
+    """
+    async with contextlib.AsyncExitStack() as stack:
+        for tenant in tenants:
+            application = tenant.application
+            await stack.enter_async_context(application)
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            stack.push_async_callback(application.stop)
+            if webhook:
+                pump = asyncio.create_task(WebhookIngress.pump_updates(tenant))
+                stack.callback(pump.cancel)
+            else:
+                await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                stack.push_async_callback(application.updater.stop)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                # Windows: остановка по KeyboardInterrupt из asyncio.run
+                pass
+
+        if webhook:
+            config = uvicorn.Config(
+                WebhookIngress(tenants),
+                host="0.0.0.0",
+                port=int(os.environ.get('PORT', 8443)),
+                lifespan="off",
+                access_log=False,
+                timeout_keep_alive=WEBHOOK_KEEP_ALIVE_SECONDS,
+                backlog=2048,
+            )
+            # uvicorn на время работы перехватывает SIGINT/SIGTERM, а после остановки
+            # повторно посылает сигнал прежнему обработчику. Обработчик выше только
+            # устанавливает stop, поэтому SIGTERM не завершает процесс до остановки ботов
+            await uvicorn.Server(config).serve()
+        else:
+            await stop.wait()
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a message to the user."""
     logger.error("Exception while handling an update:", exc_info=context.error)
+    if 'tenant' in context.bot_data:
+        context.bot_data['tenant'].metrics['errors'] += 1
     if update and update.effective_message:
         await update.effective_message.reply_text("Произошла ошибка. Пожалуйста, попробуйте еще раз.")
     elif update and update.callback_query:
@@ -772,24 +1903,40 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 # --- ОСНОВНАЯ ФУНКЦИЯ БОТА ---
 
-def main() -> None:
-    """Runs the bot."""
-    application = Application.builder().token(TOKEN).post_init(post_init).build()
-
-    # *** ВАЖНОЕ ИЗМЕНЕНИЕ: Загрузка глобального состояния из Redis при старте ***
-    load_global_event_data_from_redis()
-    
-    # *** ИЗМЕНЕНИЕ: Удаление проблемного блока из main() ***
-    # УДАЛЕНО:
-    # if loaded_message_id and loaded_chat_id:
-    #     if loaded_chat_id not in application.chat_data:
-    #         application.chat_data[loaded_chat_id] = {} # ЭТА СТРОКА ВЫЗЫВАЛА ОШИБКУ
-    #     application.chat_data[loaded_chat_id]['main_message_id'] = loaded_message_id
-    #     application.chat_data[loaded_chat_id]['main_chat_id'] = loaded_chat_id
-    #     application.chat_data[loaded_chat_id]['shuffled_teams'] = loaded_shuffled_teams
-    #     application.chat_data[loaded_chat_id]['shuffle_error'] = loaded_shuffle_error
-    #     logger.info(f"Loaded main message ID {loaded_message_id} for chat {loaded_chat_id} from Redis.")
-    # Вместо этого, `load_chat_specific_state_for_context` будет вызываться в каждом обработчике.
+def export_main(argv: list[str]) -> None:
+    """CLI: python bot.py export [--format csv|jsonl] [--chat CHAT_ID] [--output FILE]."""
+    parser = argparse.ArgumentParser(prog="bot.py export", description="Stream attendance and team history from Redis.")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default='csv', help="Output format (default: csv)")
+    parser.add_argument("--chat", type=int, help="Export only this chat (default: all chats)")
+    parser.add_argument("--output", help="Output file (default: stdout)")
+    parser.add_argument("--bot", help="Bot id from TELEGRAM_BOT_TOKENS (default: the TELEGRAM_BOT_TOKEN bot)")
+    args = parser.parse_args(argv)
+    if args.bot:
+        current_key_prefix.set(f"bot:{args.bot}:")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8', newline='') as output:
+            count = write_export(iter_export_rows(args.chat), args.format, output)
+    else:
+        sys.stdout.reconfigure(newline='')
+        count = write_export(iter_export_rows(args.chat), args.format, sys.stdout)
+    logger.info(f"Exported {count} row(s).")
+
+def build_application(tenant: Tenant) -> Application:
+    """Создает Application бота с обработчиками и фоновыми задачами."""
+    builder = (
+        Application.builder()
+        .token(tenant.token)
+        .post_init(post_init)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_MAXSIZE))
+        .concurrent_updates(TenantUpdateProcessor(tenant, TENANT_CONCURRENT_UPDATES))
+    )
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    application = builder.build()
+    application.bot_data['tenant'] = tenant
+    tenant.application = application
+
 # --- ОБРАБОТЧИКИ КОМАНД ---
     set_title_conv_handler = ConversationHandler(
         entry_points=[
@@ -803,10 +1950,14 @@ def main() -> None:
     )
     application.add_handler(set_title_conv_handler)
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("memory", memory_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("remind", remind_command))
+    application.add_handler(CommandHandler("export", export_command))
 
     # --- ОБРАБОТЧИК КНОПОК ---
     # Хендлер для выбора количества команд после "Shuffle"
-    application.add_handler(CallbackQueryHandler(handle_num_teams_selection, pattern=r'^select_teams_\d+$'))
+    application.add_handler(CallbackQueryHandler(handle_num_teams_selection, pattern=r'^select_teams_\d+_\d+(_rotate)?$'))
     # Хендлер для кнопки "Shuffle" (он теперь начинает процесс, а не сразу перемешивает)
     application.add_handler(CallbackQueryHandler(start_num_teams_selection, pattern=r'^admin_shuffle_teams$'))
     # Общий хендлер для всех остальных кнопок
@@ -815,21 +1966,54 @@ def main() -> None:
     # --- ОБРАБОТЧИК ОШИБОК ---
     application.add_error_handler(error_handler)
 
+    # --- ФОНОВЫЕ ЗАДАЧИ ---
+    application.job_queue.run_repeating(compaction_job, interval=COMPACTION_INTERVAL_SECONDS, first=60)
+    application.job_queue.run_repeating(reminder_job, interval=1, first=5)
+    application.job_queue.run_repeating(metrics_job, interval=METRICS_LOG_INTERVAL_SECONDS, first=METRICS_LOG_INTERVAL_SECONDS)
+    return application
+
+
+def main() -> None:
+    """Runs the bots."""
+    TENANTS.extend(build_tenants())
+    for tenant in TENANTS:
+        build_application(tenant)
+        with tenant_scope(tenant):
+            # Перенос данных из прежней схемы с одним глобальным событием (если они остались)
+            migrate_legacy_state()
+            # Задачи рассылки, прерванные перезапуском, возвращаются в очередь
+            recover_reminder_tasks()
+
     # --- ЗАПУСК БОТА ---
     WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
-    if WEBHOOK_URL:
-        # Режим вебхука для Render
-        application.run_webhook(
+    if WEBHOOK_URL and WEBHOOK_SERVER == "ptb":
+        # Встроенный сервер python-telegram-bot (оставлен для сравнения производительности)
+        if len(TENANTS) != 1:
+            raise ValueError("WEBHOOK_SERVER=ptb supports a single bot token only.")
+        tenant = TENANTS[0]
+        logger.info(f"Бот запущен в режиме вебхука (PTB) на Render. URL: {WEBHOOK_URL}{tenant.webhook_path}")
+        tenant.application.run_webhook(
             listen="0.0.0.0",
             port=int(os.environ.get('PORT', 8443)),
-            url_path=TOKEN,
-            webhook_url=f"{WEBHOOK_URL}/{TOKEN}"
+            url_path=tenant.webhook_path.lstrip("/"),
+            webhook_url=f"{WEBHOOK_URL}{tenant.webhook_path}",
+            secret_token=tenant.webhook_secret
         )
-        logger.info(f"Бот запущен в режиме вебхука на Render. URL: {WEBHOOK_URL}/{TOKEN}")
+        return
+
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    if WEBHOOK_URL:
+        # Режим вебхука для Render через собственный ASGI-сервер, общий для всех ботов
+        for tenant in TENANTS:
+            logger.info(f"Бот {tenant.bot_id} запущен в режиме вебхука (ASGI) на Render. URL: {WEBHOOK_URL}{tenant.webhook_path}")
     else:
         # Режим long polling для локального запуска или тестирования
-        logger.info("Бот запущен в режиме long polling.")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Боты запущены в режиме long polling: {', '.join(tenant.bot_id for tenant in TENANTS)}.")
+    asyncio.run(run_tenants(TENANTS, webhook=bool(WEBHOOK_URL)))
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ["export"]:
+        export_main(sys.argv[2:])
+    else:
+        main()
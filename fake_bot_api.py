@@ -0,0 +1,507 @@
+"""
+Локальная замена Telegram Bot API для офлайн-тестов и замеров нагрузки.
+
+Сервер реализует методы, которые вызывает бот (getMe, getUpdates, setWebhook,
+deleteWebhook, getWebhookInfo, sendMessage, sendDocument, editMessageText,
+deleteMessage, answerCallbackQuery, getChatMember), хранит отправленные сообщения
+и отвечает как Telegram: 400 "message is not modified" при редактировании
+без изменений и 429 с parameters.retry_after (RetryAfter в python-telegram-bot)
+при превышении лимитов отправки. Токен может быть любым, поэтому сервер
+подходит и для нескольких ботов из TELEGRAM_BOT_TOKENS.
+
+Запуск бота без доступа к api.telegram.org:
+    python fake_bot_api.py --port 8081 --admin 1
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081 python bot.py
+
+Обновления для бота добавляются через служебные пути; они доставляются
+через getUpdates или на вебхук, установленный ботом:
+    curl -X POST http://127.0.0.1:8081/fake/<bot_id>/updates -d '{"message": {...}}'
+
+Счетчики вызовов по методам и ошибки (объем исходящих запросов бота):
+    curl http://127.0.0.1:8081/fake/stats
+    curl -X POST http://127.0.0.1:8081/fake/reset
+"""
+import argparse
+import asyncio
+import email.parser
+import email.policy
+import itertools
+import json
+import math
+import signal
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+
+import httpx
+import uvicorn
+
+TEXT_LIMIT = 4096
+
+
+class ApiError(Exception):
+    """Ошибка метода Bot API: превращается в ответ {"ok": false, ...}."""
+
+    def __init__(self, error_code: int, description: str, parameters: dict = None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.description = description
+        self.parameters = parameters
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self) -> float:
+        """Возвращает 0, если токен есть, или время в секундах, через которое он появится."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class FakeBot:
+    """Состояние одного бота: сообщения, очередь обновлений, вебхук, лимиты и счетчики."""
+
+    def __init__(self, bot_id: int):
+        self.bot_id = bot_id
+        self.messages = {}  # (chat_id, message_id) -> (text, reply_markup)
+        self.last_message_ids = {}  # chat_id -> последний message_id (общий для бота и пользователей)
+        self.pending_updates = []
+        self.update_ids = itertools.count(1)
+        self.updates_available = asyncio.Event()
+        self.webhook_url = ""
+        self.webhook_secret = None
+        self.webhook_last_error = None
+        self.webhook_task = None
+        self.buckets = {}
+        self.calls = Counter()
+        self.errors = Counter()
+
+    def user(self) -> dict:
+        return {'id': self.bot_id, 'is_bot': True, 'first_name': f"Fake bot {self.bot_id}", 'username': f"fake_{self.bot_id}_bot"}
+
+    def next_message_id(self, chat_id) -> int:
+        self.last_message_ids[chat_id] = self.last_message_ids.get(chat_id, 0) + 1
+        return self.last_message_ids[chat_id]
+
+    def register_message(self, message: dict) -> None:
+        """
+        Запоминает сообщение пользователя (на него бот отвечает через reply_parameters),
+        при необходимости присваивая message_id и date.
+        """
+        chat_id = message['chat']['id']
+        if 'message_id' in message:
+            self.last_message_ids[chat_id] = max(self.last_message_ids.get(chat_id, 0), message['message_id'])
+        else:
+            message['message_id'] = self.next_message_id(chat_id)
+        message.setdefault('date', int(time.time()))
+        self.messages[(chat_id, message['message_id'])] = (message.get('text'), None)
+
+    def push_update(self, update: dict) -> None:
+        update.setdefault('update_id', next(self.update_ids))
+        if update.get('message'):
+            self.register_message(update['message'])
+        self.pending_updates.append(update)
+        self.updates_available.set()
+
+    def stats(self) -> dict:
+        return {
+            'calls': dict(self.calls),
+            'total_calls': sum(self.calls.values()),
+            'errors': dict(self.errors),
+            'messages': len(self.messages),
+            'pending_updates': len(self.pending_updates),
+        }
+
+
+def chat_type(chat_id) -> str:
+    if isinstance(chat_id, int) and chat_id > 0:
+        return 'private'
+    return 'supergroup' if str(chat_id).startswith("-100") else 'group'
+
+
+def parse_chat_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def parse_json_param(value):
+    """Сложные параметры (reply_markup, reply_parameters) приходят в форме как JSON-строки."""
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+
+def parse_params(content_type: bytes, body: bytes, query_string: bytes) -> dict:
+    """Разбирает параметры метода из строки запроса и тела (JSON, форма или multipart)."""
+    params = dict(parse_qsl(query_string.decode()))
+    if not body:
+        return params
+    if content_type.startswith(b'application/json'):
+        params.update(json.loads(body))
+    elif content_type.startswith(b'multipart/form-data'):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + content_type + b"\r\n\r\n" + body
+        )
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True)
+            if part.get_filename():
+                params[name] = {'file_name': part.get_filename(), 'file_size': len(payload)}
+            else:
+                params[name] = payload.decode()
+    else:
+        params.update(parse_qsl(body.decode()))
+    return params
+
+
+class FakeBotApi:
+    """ASGI-приложение, отвечающее на /bot<token>/<method> и служебные пути /fake/..."""
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        chat_rate: float = 1,
+        chat_burst: float = 3,
+        group_per_minute: float = 20,
+        flood_limits: bool = True,
+        latency: float = 0,
+        admin_ids: set = frozenset(),
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_per_minute = group_per_minute
+        self.flood_limits = flood_limits
+        self.latency = latency
+        self.admin_ids = set(admin_ids)
+        self.bots = {}
+        self.http = None
+        self.methods = {
+            'getMe': self.get_me,
+            'getUpdates': self.get_updates,
+            'setWebhook': self.set_webhook,
+            'deleteWebhook': self.delete_webhook,
+            'getWebhookInfo': self.get_webhook_info,
+            'sendMessage': self.send_message,
+            'sendDocument': self.send_document,
+            'editMessageText': self.edit_message_text,
+            'deleteMessage': self.delete_message,
+            'answerCallbackQuery': self.answer_callback_query,
+            'getChatMember': self.get_chat_member,
+        }
+
+    def get_bot(self, bot_id: int) -> FakeBot:
+        if bot_id not in self.bots:
+            self.bots[bot_id] = FakeBot(bot_id)
+        return self.bots[bot_id]
+
+    # --- HTTP ---
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            return
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        parts = scope['path'].strip("/").split("/")
+        if parts[0] == 'fake':
+            status, payload = await self.handle_control(scope['method'], parts[1:], body)
+        elif len(parts) == 2 and parts[0].startswith('bot'):
+            headers = dict(scope['headers'])
+            status, payload = await self.handle_method(
+                parts[0][3:], parts[1], headers.get(b'content-type', b''), body, scope['query_string']
+            )
+        else:
+            status, payload = 404, {'ok': False, 'error_code': 404, 'description': "Not Found"}
+
+        response = json.dumps(payload).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(response)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': response})
+
+    async def handle_method(self, token: str, method: str, content_type: bytes, body: bytes, query_string: bytes) -> tuple[int, dict]:
+        bot_id, _, secret = token.partition(":")
+        if not bot_id.isdigit() or not secret:
+            return 401, {'ok': False, 'error_code': 401, 'description': "Unauthorized"}
+        bot = self.get_bot(int(bot_id))
+        bot.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        handler = self.methods.get(method)
+        try:
+            if handler is None:
+                raise ApiError(404, "Not Found")
+            result = await handler(bot, parse_params(content_type, body, query_string))
+        except ApiError as e:
+            bot.errors[f"{method} {e.error_code}"] += 1
+            payload = {'ok': False, 'error_code': e.error_code, 'description': e.description}
+            if e.parameters:
+                payload['parameters'] = e.parameters
+            return e.error_code, payload
+        return 200, {'ok': True, 'result': result}
+
+    async def handle_control(self, method: str, parts: list[str], body: bytes) -> tuple[int, dict]:
+        """Служебные пути: добавление обновлений, счетчики и их сброс."""
+        if parts == ['stats'] and method == 'GET':
+            return 200, {str(bot_id): bot.stats() for bot_id, bot in self.bots.items()}
+        if parts == ['reset'] and method == 'POST':
+            for bot in self.bots.values():
+                bot.calls.clear()
+                bot.errors.clear()
+                bot.buckets.clear()
+            return 200, {'ok': True}
+        if len(parts) == 2 and parts[0].isdigit() and parts[1] == 'updates' and method == 'POST':
+            bot = self.get_bot(int(parts[0]))
+            updates = json.loads(body)
+            for update in updates if isinstance(updates, list) else [updates]:
+                bot.push_update(update)
+            return 200, {'ok': True, 'pending_updates': len(bot.pending_updates)}
+        return 404, {'ok': False, 'description': "Not Found"}
+
+    # --- Лимиты ---
+    def check_flood(self, bot: FakeBot, chat_id) -> None:
+        """
+        Лимиты Telegram для отправки: около 30 сообщений в секунду на бота,
+        1 в секунду в личный чат (с небольшим запасом) и 20 в минуту в группу.
+        Токены забираются, только если их хватает во всех корзинах: отклоненный
+        запрос не расходует общий лимит бота.
+        """
+        if not self.flood_limits:
+            return
+        buckets = [('global', self.global_rate, self.global_rate)]
+        if chat_type(chat_id) == 'private':
+            buckets.append((chat_id, self.chat_rate, self.chat_burst))
+        else:
+            buckets.append((chat_id, self.group_per_minute / 60, self.group_per_minute))
+        for key, rate, capacity in buckets:
+            if key not in bot.buckets:
+                bot.buckets[key] = TokenBucket(rate, capacity)
+        wait = max(bot.buckets[key].wait_time() for key, _, _ in buckets)
+        if wait:
+            retry_after = max(1, math.ceil(wait))
+            raise ApiError(429, f"Too Many Requests: retry after {retry_after}", {'retry_after': retry_after})
+        for key, _, _ in buckets:
+            bot.buckets[key].take()
+
+    # --- Методы Bot API ---
+    async def get_me(self, bot: FakeBot, params: dict) -> dict:
+        return {**bot.user(), 'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+
+    async def get_updates(self, bot: FakeBot, params: dict) -> list:
+        if bot.webhook_url:
+            raise ApiError(409, "Conflict: can't use getUpdates method while webhook is active; use deleteWebhook to delete the webhook first")
+        offset = int(params.get('offset') or 0)
+        if offset:
+            bot.pending_updates = [update for update in bot.pending_updates if update['update_id'] >= offset]
+        if not bot.pending_updates:
+            bot.updates_available.clear()
+            try:
+                await asyncio.wait_for(bot.updates_available.wait(), float(params.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        return bot.pending_updates[:int(params.get('limit') or 100)]
+
+    async def set_webhook(self, bot: FakeBot, params: dict) -> bool:
+        if not params.get('url'):
+            return await self.delete_webhook(bot, params)
+        if str(params.get('drop_pending_updates')).lower() == 'true':
+            bot.pending_updates.clear()
+        bot.webhook_url = params['url']
+        bot.webhook_secret = params.get('secret_token')
+        bot.webhook_last_error = None
+        if bot.webhook_task is None:
+            bot.webhook_task = asyncio.create_task(self.deliver_webhook(bot))
+        return True
+
+    async def delete_webhook(self, bot: FakeBot, params: dict) -> bool:
+        if str(params.get('drop_pending_updates')).lower() == 'true':
+            bot.pending_updates.clear()
+        bot.webhook_url = ""
+        bot.webhook_secret = None
+        if bot.webhook_task is not None:
+            bot.webhook_task.cancel()
+            bot.webhook_task = None
+        return True
+
+    async def get_webhook_info(self, bot: FakeBot, params: dict) -> dict:
+        info = {'url': bot.webhook_url, 'has_custom_certificate': False, 'pending_update_count': len(bot.pending_updates)}
+        if bot.webhook_last_error:
+            info['last_error_date'], info['last_error_message'] = bot.webhook_last_error
+        return info
+
+    async def deliver_webhook(self, bot: FakeBot) -> None:
+        """Доставляет обновления на вебхук по одному, повторяя неудачные попытки, как Telegram."""
+        if self.http is None:
+            self.http = httpx.AsyncClient(timeout=10)
+        while True:
+            if not bot.pending_updates:
+                bot.updates_available.clear()
+                await bot.updates_available.wait()
+                continue
+            update = bot.pending_updates[0]
+            headers = {'X-Telegram-Bot-Api-Secret-Token': bot.webhook_secret} if bot.webhook_secret else {}
+            try:
+                response = await self.http.post(bot.webhook_url, json=update, headers=headers)
+                error = None if response.status_code == 200 else f"Wrong response from the webhook: {response.status_code}"
+            except httpx.HTTPError as e:
+                error = f"Connection failed: {e!r}"
+            if error is None:
+                bot.pending_updates.pop(0)
+            else:
+                bot.webhook_last_error = (int(time.time()), error)
+                await asyncio.sleep(1)
+
+    def make_message(self, bot: FakeBot, chat_id, message_id: int, **fields) -> dict:
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': chat_type(chat_id)},
+            'from': bot.user(),
+        }
+        if message['chat']['type'] != 'private':
+            message['chat']['title'] = f"Chat {chat_id}"
+        message.update({key: value for key, value in fields.items() if value is not None})
+        return message
+
+    def store_message(self, bot: FakeBot, params: dict, text: str, reply_markup) -> tuple:
+        """Проверяет лимиты и ответ на сообщение и сохраняет новое сообщение."""
+        chat_id = parse_chat_id(params.get('chat_id'))
+        if chat_id is None:
+            raise ApiError(400, "Bad Request: chat_id is empty")
+        self.check_flood(bot, chat_id)
+        reply = parse_json_param(params.get('reply_parameters'))
+        if reply and (chat_id, int(reply['message_id'])) not in bot.messages and not reply.get('allow_sending_without_reply'):
+            raise ApiError(400, "Bad Request: message to be replied not found")
+        message_id = bot.next_message_id(chat_id)
+        bot.messages[(chat_id, message_id)] = (text, reply_markup)
+        return chat_id, message_id
+
+    async def send_message(self, bot: FakeBot, params: dict) -> dict:
+        text = params.get('text') or ""
+        if not text.strip():
+            raise ApiError(400, "Bad Request: message text is empty")
+        if len(text) > TEXT_LIMIT:
+            raise ApiError(400, "Bad Request: message is too long")
+        reply_markup = parse_json_param(params.get('reply_markup'))
+        chat_id, message_id = self.store_message(bot, params, text, reply_markup)
+        return self.make_message(bot, chat_id, message_id, text=text, reply_markup=reply_markup)
+
+    async def send_document(self, bot: FakeBot, params: dict) -> dict:
+        document = params.get('document')
+        if not isinstance(document, dict):
+            raise ApiError(400, "Bad Request: there is no document in the request")
+        caption = params.get('caption')
+        chat_id, message_id = self.store_message(bot, params, caption, None)
+        file_id = f"fake-{bot.bot_id}-{chat_id}-{message_id}"
+        return self.make_message(
+            bot, chat_id, message_id, caption=caption,
+            document={'file_id': file_id, 'file_unique_id': file_id, **document},
+        )
+
+    async def edit_message_text(self, bot: FakeBot, params: dict):
+        if params.get('inline_message_id'):
+            return True
+        chat_id = parse_chat_id(params.get('chat_id'))
+        key = (chat_id, int(params.get('message_id') or 0))
+        if key not in bot.messages:
+            raise ApiError(400, "Bad Request: message to edit not found")
+        text = params.get('text') or ""
+        if not text.strip():
+            raise ApiError(400, "Bad Request: message text is empty")
+        reply_markup = parse_json_param(params.get('reply_markup'))
+        if bot.messages[key] == (text, reply_markup):
+            raise ApiError(
+                400,
+                "Bad Request: message is not modified: specified new message content and reply markup "
+                "are exactly the same as a current content and reply markup of the message",
+            )
+        self.check_flood(bot, chat_id)
+        bot.messages[key] = (text, reply_markup)
+        return self.make_message(bot, chat_id, key[1], text=text, reply_markup=reply_markup, edit_date=int(time.time()))
+
+    async def delete_message(self, bot: FakeBot, params: dict) -> bool:
+        key = (parse_chat_id(params.get('chat_id')), int(params.get('message_id') or 0))
+        if bot.messages.pop(key, None) is None:
+            raise ApiError(400, "Bad Request: message to delete not found")
+        return True
+
+    async def answer_callback_query(self, bot: FakeBot, params: dict) -> bool:
+        if not params.get('callback_query_id'):
+            raise ApiError(400, "Bad Request: query is too old and response timeout expired or query ID is invalid")
+        return True
+
+    async def get_chat_member(self, bot: FakeBot, params: dict) -> dict:
+        user_id = int(params['user_id'])
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"}
+        if user_id in self.admin_ids:
+            return {'status': 'creator', 'user': user, 'is_anonymous': False}
+        return {'status': 'member', 'user': user}
+
+
+async def serve(api: FakeBotApi, host: str, port: int) -> None:
+    """Запускает сервер и после остановки выводит счетчики вызовов."""
+    server = uvicorn.Server(uvicorn.Config(api, host=host, port=port, lifespan="off", access_log=False))
+    # После остановки uvicorn повторно посылает перехваченный сигнал прежнему
+    # обработчику; без своего обработчика SIGTERM завершил бы процесс до вывода счетчиков
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, server.handle_exit, sig, None)
+        except NotImplementedError:
+            pass
+    try:
+        await server.serve()
+    finally:
+        if api.http is not None:
+            await api.http.aclose()
+    for bot_id, bot in api.bots.items():
+        print(f"bot {bot_id}: {json.dumps(bot.stats())}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local Telegram Bot API stand-in for offline tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--global-rate", type=float, default=30, help="Messages per second per bot")
+    parser.add_argument("--chat-rate", type=float, default=1, help="Messages per second per private chat")
+    parser.add_argument("--chat-burst", type=float, default=3, help="Burst allowed in a private chat")
+    parser.add_argument("--group-per-minute", type=float, default=20, help="Messages per minute per group")
+    parser.add_argument("--no-flood", action="store_true", help="Disable flood limits (429 responses)")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Delay added to every API call")
+    parser.add_argument("--admin", type=int, action="append", default=[], help="User id reported as chat owner by getChatMember")
+    args = parser.parse_args()
+
+    api = FakeBotApi(
+        global_rate=args.global_rate,
+        chat_rate=args.chat_rate,
+        chat_burst=args.chat_burst,
+        group_per_minute=args.group_per_minute,
+        flood_limits=not args.no_flood,
+        latency=args.latency_ms / 1000,
+        admin_ids=set(args.admin),
+    )
+    asyncio.run(serve(api, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
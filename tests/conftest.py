@@ -0,0 +1,27 @@
+"""
+Общая настройка тестов: bot.py читает переменные окружения и подключается к Redis
+при импорте, поэтому окружение и Redis в памяти (fakeredis) настраиваются до импорта.
+"""
+import os
+import sys
+
+import fakeredis
+import pytest
+import redis
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST-TOKEN")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+_redis_server = fakeredis.FakeServer()
+redis.from_url = lambda url, **kwargs: fakeredis.FakeRedis(server=_redis_server, **kwargs)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def clean_redis():
+    bot.r.flushall()
+    yield
+    bot.r.flushall()
@@ -0,0 +1,187 @@
+"""
+Сценарии обработчиков против fake_bot_api.py: бот ходит в локальный сервер Bot API
+по HTTP, а тест проверяет число исходящих вызовов по методам.
+"""
+import asyncio
+import itertools
+import json
+import socket
+
+import httpx
+import pytest
+import uvicorn
+from telegram import Update
+
+import bot
+import fake_bot_api
+
+CHAT_ID = -1001
+ADMIN_ID = 1
+
+
+class Scenario:
+    """Бот и fake_bot_api в одном цикле событий; обновления обрабатываются по одному до конца."""
+
+    def __init__(self, api: fake_bot_api.FakeBotApi, tenant: bot.Tenant):
+        self.api = api
+        self.tenant = tenant
+        self.application = tenant.application
+        self.fake_bot = api.get_bot(int(tenant.bot_id))
+        self.ids = itertools.count(1)
+
+    def user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+
+    async def process(self, data: dict) -> None:
+        update = Update.de_json({'update_id': next(self.ids), **data}, self.application.bot)
+        await self.application.update_processor.process_update(update, self.application.process_update(update))
+
+    async def message(self, user_id: int, text: str) -> None:
+        message = {'chat': {'id': CHAT_ID, 'type': 'supergroup', 'title': "Football"}, 'from': self.user(user_id), 'text': text}
+        if text.startswith("/"):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        self.fake_bot.register_message(message)
+        await self.process({'message': message})
+
+    async def press(self, user_id: int, message_id: int, data: str) -> None:
+        await self.process({'callback_query': {
+            'id': str(next(self.ids)),
+            'chat_instance': "test",
+            'data': data,
+            'from': self.user(user_id),
+            'message': {'message_id': message_id, 'date': 0, 'chat': {'id': CHAT_ID, 'type': 'supergroup'}, 'text': "-"},
+        }})
+
+
+async def run_scenario(steps, **api_options) -> fake_bot_api.FakeBotApi:
+    api = fake_bot_api.FakeBotApi(**api_options)
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(api, lifespan="off", log_level="warning"))
+    serving = asyncio.create_task(server.serve(sockets=[sock]))
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    bot.TELEGRAM_API_BASE_URL = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    tenant = bot.Tenant(bot.TOKEN, legacy=True)
+    bot.build_application(tenant)
+    try:
+        async with tenant.application:
+            await steps(Scenario(api, tenant))
+    finally:
+        server.should_exit = True
+        await serving
+        if api.http is not None:
+            await api.http.aclose()
+    return api
+
+
+@pytest.fixture(autouse=True)
+def restore_base_url():
+    base_url = bot.TELEGRAM_API_BASE_URL
+    yield
+    bot.TELEGRAM_API_BASE_URL = base_url
+
+
+def test_event_flow_outbound_api_calls():
+    result = {}
+
+    async def steps(scenario: Scenario) -> None:
+        await scenario.message(ADMIN_ID, "/start")
+        await scenario.message(ADMIN_ID, "Friday")
+        event = bot.list_active_events(CHAT_ID)[0]
+        main_message_id = event['main_message_id']
+
+        for user_id in (1, 2, 3, 4):
+            await scenario.press(user_id, main_message_id, 'set_status_going')
+        # Повторный голос не меняет текст: Telegram отвечает "message is not modified"
+        await scenario.press(1, main_message_id, 'set_status_going')
+
+        await scenario.press(ADMIN_ID, main_message_id, 'admin_close_collection')
+        await scenario.press(ADMIN_ID, main_message_id, 'admin_shuffle_teams')
+        prompt_message_id = scenario.application.chat_data[CHAT_ID]['shuffle_prompts'][event['id']]
+        await scenario.press(ADMIN_ID, prompt_message_id, f"select_teams_{event['id']}_2")
+        await scenario.press(ADMIN_ID, main_message_id, 'admin_finish_event')
+        result['stats'] = scenario.fake_bot.stats()
+
+    asyncio.run(run_scenario(steps, flood_limits=False))
+
+    stats = result['stats']
+    assert stats['calls'] == {
+        'getMe': 1,
+        'sendMessage': 4,
+        'editMessageText': 8,
+        'answerCallbackQuery': 9,
+        'deleteMessage': 1,
+    }
+    assert stats['errors'] == {'editMessageText 400': 1}
+    assert bot.list_active_events(CHAT_ID) == []
+    assert bot.r_bin.llen(bot.redis_key(bot.EVENT_ARCHIVE_KEY, CHAT_ID)) == 1
+
+
+def test_edit_without_changes_is_rejected():
+    api = fake_bot_api.FakeBotApi()
+
+    async def call(client, method, **params):
+        response = await client.post(f"/bot42:secret/{method}", data=params)
+        return response.status_code, response.json()
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api), base_url="http://fake") as client:
+            status, sent = await call(client, 'sendMessage', chat_id=7, text="hi")
+            assert status == 200
+            message_id = sent['result']['message_id']
+            status, error = await call(client, 'editMessageText', chat_id=7, message_id=message_id, text="hi")
+            assert status == 400
+            assert error['description'].startswith("Bad Request: message is not modified")
+            status, _ = await call(client, 'editMessageText', chat_id=7, message_id=message_id, text="hello")
+            assert status == 200
+
+    asyncio.run(scenario())
+    assert api.bots[42].errors == {'editMessageText 400': 1}
+
+
+def test_flood_limit_rejection_does_not_spend_global_tokens():
+    api = fake_bot_api.FakeBotApi(global_rate=30, group_per_minute=2)
+    fake_bot = api.get_bot(42)
+
+    api.check_flood(fake_bot, CHAT_ID)
+    api.check_flood(fake_bot, CHAT_ID)
+    global_tokens = fake_bot.buckets['global'].tokens
+    with pytest.raises(fake_bot_api.ApiError) as error:
+        api.check_flood(fake_bot, CHAT_ID)
+
+    assert error.value.error_code == 429
+    assert error.value.parameters['retry_after'] >= 1
+    assert fake_bot.buckets['global'].tokens == pytest.approx(global_tokens, abs=0.01)
+
+
+def test_reminder_retry_after_pauses_only_that_chat():
+    busy_group, other_group = -2001, -2002
+    result = {}
+
+    async def steps(scenario: Scenario) -> None:
+        tasks = [{'c': busy_group, 't': f"busy {i}", 'r': 1} for i in range(6)]
+        tasks += [{'c': other_group, 't': f"other {i}", 'r': 1} for i in range(3)]
+        bot.r.rpush(bot.redis_key(bot.REMINDER_QUEUE_KEY), *map(json.dumps, tasks))
+
+        class JobContext:
+            bot = scenario.application.bot
+            bot_data = scenario.application.bot_data
+
+        for _ in range(2):
+            await bot.reminder_job(JobContext)
+        result['bot_data'] = dict(scenario.application.bot_data)
+        result['sent'] = [text for (chat_id, _), (text, _) in scenario.fake_bot.messages.items()]
+
+    asyncio.run(run_scenario(steps, group_per_minute=3))
+
+    # Группа сверх лимита получила 3 сообщения и стоит на паузе, остальные задачи ждут в очереди
+    assert sorted(result['sent']) == ["busy 0", "busy 1", "busy 2", "other 0", "other 1", "other 2"]
+    assert 'reminders_paused_until' not in result['bot_data']
+    assert bot.r.exists(bot.redis_key(bot.REMINDER_CHAT_PAUSE_KEY, busy_group))
+    assert not bot.r.exists(bot.redis_key(bot.REMINDER_CHAT_PAUSE_KEY, other_group))
+    queued = [json.loads(task) for task in bot.r.lrange(bot.redis_key(bot.REMINDER_QUEUE_KEY), 0, -1)]
+    assert sorted(task['t'] for task in queued) == ["busy 3", "busy 4", "busy 5"]
+    assert bot.r.llen(bot.redis_key(bot.REMINDER_PROCESSING_KEY)) == 0
+    assert bot.r.hget(bot.redis_key(bot.REMINDER_RUN_KEY, 1), 'sent') == "6"
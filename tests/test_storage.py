@@ -0,0 +1,95 @@
+import csv
+import io
+import json
+
+import numpy as np
+
+import bot
+
+
+def make_event(chat_id=-100, participants=None, plus_ones=None, team_ids=None):
+    event = bot.new_event(chat_id)
+    event['title'] = "Friday"
+    event['participants'] = participants or {
+        '1': {'name': "Ann", 'status': 'going'},
+        '2': {'name': "Bob", 'status': 'maybe'},
+        '3': {'name': "Cid", 'status': 'going'},
+    }
+    event['plus_ones'] = plus_ones if plus_ones is not None else [{'added_by_id': 1, 'added_by_name': "Ann"}]
+    if team_ids:
+        event['shuffled_team_ids'] = team_ids
+    return event
+
+
+def test_archive_pack_round_trip():
+    event = make_event(team_ids=[[1], [3]])
+    restored = bot.unpack_archived_event(bot.pack_archived_event(event))
+
+    assert restored['id'] == event['id']
+    assert restored['title'] == "Friday"
+    assert restored['participants'] == {
+        '1': {'name': "Ann", 'status': 'going'},
+        '2': {'name': "Bob", 'status': 'maybe'},
+        '3': {'name': "Cid", 'status': 'going'},
+    }
+    assert restored['plus_ones'] == [{'added_by_id': 1}]
+    assert restored['shuffled_team_ids'] == [[1], [3]]
+
+
+def test_archive_event_skips_empty_events_and_sets_ttl():
+    assert not bot.archive_event(make_event(participants={'1': {'name': "Ann", 'status': None}}, plus_ones=[]))
+    assert bot.archive_event(make_event())
+
+    archive_key = bot.redis_key(bot.EVENT_ARCHIVE_KEY, -100)
+    assert bot.r_bin.llen(archive_key) == 1
+    assert 0 < bot.r.ttl(archive_key) <= bot.ARCHIVE_TTL_SECONDS
+
+
+def test_record_coplay_counts_each_pair_once_per_team():
+    bot.record_coplay(-100, [[10, 20, 30], [40]])
+    bot.record_coplay(-100, [[10, 20], [30, 40]])
+
+    coplay = bot.coplay_submatrix(-100, [10, 20, 30, 40])
+    assert coplay.tolist() == [
+        [0, 2, 1, 0],
+        [2, 0, 1, 0],
+        [1, 1, 0, 1],
+        [0, 0, 1, 0],
+    ]
+
+
+def test_minimize_repeat_pairings_separates_frequent_teammates():
+    # Игроки 0-1 и 2-3 часто играли вместе: лучший расклад на 2 команды разводит обе пары
+    coplay = np.zeros((4, 4), dtype=np.int64)
+    coplay[0, 1] = coplay[1, 0] = 5
+    coplay[2, 3] = coplay[3, 2] = 5
+
+    assignment = bot.minimize_repeat_pairings(coplay, 2, time_budget=0.05, seed=1)
+
+    assert sorted(np.bincount(assignment, minlength=2).tolist()) == [2, 2]
+    assert assignment[0] != assignment[1]
+    assert assignment[2] != assignment[3]
+
+
+def test_export_rows_have_one_type_per_column():
+    bot.archive_event(make_event(team_ids=[[1], [3]]))
+
+    jsonl = io.StringIO()
+    assert bot.write_export(bot.iter_export_rows(), 'jsonl', jsonl) == 4
+    rows = [json.loads(line) for line in jsonl.getvalue().splitlines()]
+    assert all(isinstance(row['chat_id'], int) and isinstance(row['user_id'], int) for row in rows)
+    assert [(row['user_id'], row['vote'], row['team']) for row in rows] == [
+        (1, 'going', 1), (2, 'maybe', None), (3, 'going', 2), (1, 'plus_one', None),
+    ]
+    assert rows == list(map(json.loads, _export_lines(-100)))
+
+    csv_output = io.StringIO()
+    bot.write_export(bot.iter_export_rows(-100), 'csv', csv_output)
+    csv_rows = list(csv.DictReader(io.StringIO(csv_output.getvalue())))
+    assert [(row['user_id'], row['team']) for row in csv_rows] == [('1', '1'), ('2', ''), ('3', '2'), ('1', '')]
+
+
+def _export_lines(chat_id):
+    output = io.StringIO()
+    bot.write_export(bot.iter_export_rows(chat_id), 'jsonl', output)
+    return output.getvalue().splitlines()
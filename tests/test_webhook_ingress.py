@@ -0,0 +1,39 @@
+import asyncio
+
+import bot
+
+
+def call_ingress(ingress, tenant, headers, body=b'{"update_id": 1}'):
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        'type': 'http',
+        'method': 'POST',
+        'path': tenant.webhook_path,
+        'headers': [(b'x-telegram-bot-api-secret-token', tenant.webhook_secret.encode()), *headers],
+    }
+    asyncio.run(ingress(scope, receive, send))
+    return sent[0]['status']
+
+
+def test_ingress_rejects_bad_content_length():
+    tenant = bot.Tenant(bot.TOKEN, legacy=True)
+    ingress = bot.WebhookIngress([tenant])
+
+    assert call_ingress(ingress, tenant, [(b'transfer-encoding', b'chunked')]) == 411
+    assert call_ingress(ingress, tenant, [(b'content-length', b'abc')]) == 400
+    too_large = str(bot.WEBHOOK_MAX_BODY_BYTES + 1).encode()
+    assert call_ingress(ingress, tenant, [(b'content-length', too_large)]) == 413
+    # Тело длиннее заявленного Content-Length
+    assert call_ingress(ingress, tenant, [(b'content-length', b'2')]) == 413
+    assert tenant.metrics['rejected'] == 4
+
+    assert call_ingress(ingress, tenant, [(b'content-length', b'16')]) == 200
+    assert tenant.metrics['received'] == 1
+    assert tenant.raw_updates.get_nowait() == b'{"update_id": 1}'